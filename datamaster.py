@@ -13,19 +13,55 @@
 import signal
 import sys
 import gc
+import ast
+import hashlib
+import importlib
 import getopt
 import os
+import io
+import base64
+import socket
+import socketserver
+import stat
+import struct
+import tempfile
+import threading
+import multiprocessing
+import csv
+import json
+import time
+import tracemalloc
+
+class _LazyModule(object):
+    '''
+    * Internal *
+
+    Imports a module on first attribute access, so commands that never draw
+    (-l, -v, -h, -g, ...) do not pay for it
+    '''
+
+    def __init__(self, name):
+        self._name   = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+
+        return getattr(self._module, attr)
 
-# importing matplotlib so datamaster prints all requested plots at once
-import matplotlib.pyplot as plt
+# matplotlib is only imported once a plot runs; datamaster still shows all requested plots at once
+plt = _LazyModule('matplotlib.pyplot')
 
 cli_thread   = True # If false, the CLI terminates; goes false upon SIGKILL
 
 PROJECTS         = []   # List of all known projects given by subdirectories
 current_projects = {}   # Key-value memory of active projects
 selected_project = None # Name of current selected project; used for reloads
+INDEX_PATH       = '.datamaster.index' # Cached target index of each project, see targets()
+module_state     = {}   # Project name -> {module name: (mtime, source hash)} as of the last (re)load
 
-VERSION      = '1.2.0' # Current version of DataMaster
+VERSION      = '1.3.0' # Current version of DataMaster
 
 def fetch_project(name, load):
     '''
@@ -48,19 +84,11 @@ def fetch_project(name, load):
 
     elif name in current_projects and load:
         try:
-            unload_project(name)
-
-            obj = load_project(name)
-
-            if obj is None:
-                print('Reload of %s failed; Try loading directly from file?' % (name))
-
-                unload_project(name)
-                return None
-            else:
-                current_projects[name] = obj
+            obj = reload_project(name)
+            current_projects[name] = obj
 
         except Exception as err:
+            # Nothing is marked as reloaded, so the next reload retries every changed module
             print('Reload of project failed')
             print(str(err))
     else:
@@ -84,6 +112,7 @@ def load_project(name):
             obj = None
         else:
             current_projects[name] = obj
+            track_project(name)
     except Exception as err:
         print('Project could not be loaded')
         print(str(err))
@@ -93,6 +122,138 @@ def load_project(name):
 
     return obj
 
+#### Hot reload ####
+def _project_modules(name):
+    '''
+    * Internal *
+
+    Loaded modules of a project that come from a source file
+    '''
+    return dict((m, mod) for m, mod in sys.modules.items()
+                if (m == name or m.startswith('%s.' % (name))) and mod is not None and getattr(mod, '__file__', None))
+
+def _source_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def track_project(name):
+    '''
+    Records the mtime and source hash of every module of a project
+    '''
+    state = {}
+
+    for m, mod in _project_modules(name).items():
+        if os.path.exists(mod.__file__):
+            old = module_state.get(name, {}).get(m)
+            mtime = os.path.getmtime(mod.__file__)
+
+            # Only rehash files that were touched
+            state[m] = old if old is not None and old[0] == mtime else (mtime, _source_hash(mod.__file__))
+
+    module_state[name] = state
+
+def _imports(m, mod, known):
+    '''
+    * Internal *
+
+    Modules in known that the source of module m imports
+    '''
+    with open(mod.__file__, 'rb') as f:
+        tree = ast.parse(f.read(), mod.__file__)
+
+    # Relative imports resolve against the package that contains m (or m itself for an __init__)
+    package = m if os.path.basename(mod.__file__).startswith('__init__.') else m.rpartition('.')[0]
+    deps    = set()
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            targets = [alias.name for alias in node.names]
+
+        elif isinstance(node, ast.ImportFrom):
+            if node.level > 0:
+                base = '.'.join(package.split('.')[:len(package.split('.')) - node.level + 1])
+                base = base + '.' + node.module if node.module else base
+            else:
+                base = node.module
+
+            # 'from pkg import name' may name a submodule as well as an attribute
+            targets = [base] + ['%s.%s' % (base, alias.name) for alias in node.names]
+        else:
+            continue
+
+        deps.update(t for t in targets if t in known and t != m)
+
+    return deps
+
+def reload_project(name):
+    '''
+    Re-imports only the modules of a project whose source changed, plus every module
+    importing them, dependencies first; everything else (and its state) is kept
+
+    A module defining restore(old) is called after its reload with its previous
+    globals, so it can carry over objects that are still valid (pupils, caches, ...).
+    Returns the project module.
+    '''
+    modules = _project_modules(name)
+    state   = module_state.get(name, {})
+    changed = set()
+
+    for m, mod in modules.items():
+        if not os.path.exists(mod.__file__):
+            continue
+
+        old = state.get(m)
+
+        if old is None or (old[0] != os.path.getmtime(mod.__file__) and old[1] != _source_hash(mod.__file__)):
+            changed.add(m)
+
+    deps = dict((m, _imports(m, mod, modules)) for m, mod in modules.items() if os.path.exists(mod.__file__))
+
+    # Everything that (transitively) imports a changed module is stale too
+    dirty = set(changed)
+    grown = True
+
+    while grown:
+        stale = set(m for m, d in deps.items() if m not in dirty and d & dirty)
+        dirty |= stale
+        grown  = len(stale) != 0
+
+    if len(dirty) == 0:
+        print('No changes in %s' % (name))
+        track_project(name)
+        return sys.modules[name]
+
+    order = []
+    seen  = set()
+
+    def visit(m):
+        if m in seen:
+            return
+
+        seen.add(m)
+
+        for d in sorted(deps.get(m, ())):
+            if d in dirty:
+                visit(d)
+
+        order.append(m)
+
+    for m in sorted(dirty):
+        visit(m)
+
+    for m in order:
+        old    = dict(vars(modules[m])) # reload() re-executes the module in the same namespace
+        module = importlib.reload(modules[m])
+
+        print('Reloaded %s' % (m))
+
+        if callable(getattr(module, 'restore', None)):
+            module.restore(old)
+
+    track_project(name)
+
+    return sys.modules[name]
+
 def unload_project(name):
     '''
     * Internal *
@@ -100,10 +261,12 @@ def unload_project(name):
     Removes all references of a project from memory
     '''
 
-    # Firstly, if the object has terminate(), call it; useful for freeing memory
+    # Firstly, if the object has release() (or the older terminate()), call it; useful for freeing memory
     obj = current_projects[name]
 
-    if hasattr(obj.project, 'terminate') and callable(getattr(obj.project, 'terminate')):
+    if hasattr(obj.project, 'release') and callable(getattr(obj.project, 'release')):
+        getattr(obj.project, 'release')()
+    elif hasattr(obj.project, 'terminate') and callable(getattr(obj.project, 'terminate')):
         getattr(obj.project, 'terminate')()
 
     # Now, purge references
@@ -131,19 +294,111 @@ def unload_project(name):
     if name in current_projects:
         del current_projects[name]
 
+    if name in module_state:
+        del module_state[name]
+
     gc.collect()
 
 def select_project(name, load=False):
-    project = fetch_project(name, load)
+    '''
+    Selects a project; it is only imported once one of its targets runs
+    load: Reload the project if it is already loaded
+    '''
+    if name not in PROJECTS:
+        print('Invalid project name')
+        return
+
+    if load and name in current_projects and fetch_project(name, True) is None:
+        return
+
+    global selected_project
+    selected_project = name
+    print('Selected Project: %s\n' % (selected_project))
+
+def project_module(name):
+    '''
+    Loaded module of a project, importing it on first use; None if it cannot be loaded
+    '''
+    obj = current_projects.get(name)
+
+    if obj is None:
+        obj = load_project(name)
+
+    return obj
+
+#### Target index ####
+_index = None # Contents of INDEX_PATH: project.py path -> {'mtime', 'size', 'targets'}
+
+def _scan_targets(path):
+    '''
+    * Internal *
+
+    Names of the top-level get_/plot_/run_ functions (defined, imported or assigned) in a file
+    '''
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), path)
+
+    names = []
+
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            names.append(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            names.extend((alias.asname or alias.name).split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.Assign):
+            names.extend(t.id for t in node.targets if isinstance(t, ast.Name))
+
+    found = {'get': [], 'plot': [], 'run': []}
+
+    for n in sorted(set(names)):
+        prefix = n.split('_', 1)[0]
+
+        if prefix in found and '_' in n:
+            found[prefix].append(n.split('_', 1)[1])
+
+    return found
+
+def targets(name):
+    '''
+    {'get': [...], 'plot': [...], 'run': [...]} of a project, found by a static scan of
+    its project.py without importing it; the index is cached on disk and rebuilt for
+    files whose mtime or size changed
+    '''
+    global _index
+
+    path = os.path.join(name, 'project.py')
+    st   = os.stat(path)
+
+    if _index is None:
+        try:
+            with open(INDEX_PATH) as f:
+                _index = json.load(f)
+        except (IOError, ValueError):
+            _index = {}
+
+    entry = _index.get(path)
+
+    if entry is None or entry['mtime'] != st.st_mtime or entry['size'] != st.st_size:
+        entry = {'mtime': st.st_mtime, 'size': st.st_size, 'targets': _scan_targets(path)}
+        _index[path] = entry
+
+        try:
+            with open(INDEX_PATH, 'w') as f:
+                json.dump(_index, f)
+        except IOError:
+            pass # A read-only checkout just rescans next time
+
+    return entry['targets']
+
+def plot_var(var, name=None):
+    if name is None:
+        name = selected_project
 
-    if project is not None:
-        global selected_project
-        selected_project = name
-        print('Selected Project: %s\n' % (selected_project))
+    if name is not None:
+        obj = project_module(name)
 
-def plot_var(var):
-    if selected_project is not None:
-        obj = current_projects[selected_project]
+        if obj is None:
+            return False
 
         if str(var) == 'all':
 
@@ -163,9 +418,155 @@ def plot_var(var):
         usage()
         return False
 
-def get_var(var):
-    if selected_project is not None:
-        obj = current_projects[selected_project]
+#### Batch rendering ####
+_batch_project = None # Project module of a batch worker, set by _batch_init
+
+def _batch_init(name, threads=None):
+    '''
+    * Internal *
+
+    Pool initializer: draws off-screen and loads the project once per worker
+
+    threads: Share of the cores for this worker, passed to the project's threads(n)
+             hook (if it has one) so the pool does not run processes × cores FFT threads
+    '''
+    global _batch_project
+
+    plt.switch_backend('Agg')
+    _batch_project = __import__(name).project
+
+    hook = getattr(_batch_project, 'threads', None)
+
+    if threads is not None and callable(hook):
+        hook(threads)
+
+def _batch_render(task):
+    '''
+    * Internal *
+
+    Calls one plot function and saves every figure it opened
+    Returns (variable, saved paths, error message or None)
+    '''
+    var, outdir, fmt, dpi = task
+    paths = []
+
+    plt.close('all')
+
+    try:
+        getattr(_batch_project, ('plot_%s' % (var)))()
+
+        paths = save_figures(var, [plt.figure(num) for num in plt.get_fignums()], outdir, fmt, dpi)
+    except Exception as err:
+        return var, paths, str(err)
+    finally:
+        plt.close('all')
+
+    return var, paths, None
+
+def _report(var, paths, err):
+    '''
+    * Internal *
+
+    Prints the outcome of one batch plot; returns True if it failed
+    '''
+    if err is not None:
+        print('%s failed: %s' % (var, err))
+    elif len(paths) == 0:
+        print('%s drew no figure' % (var))
+    else:
+        for path in paths:
+            print('Saved %s' % (path))
+
+    return err is not None
+
+def plot_names(obj):
+    # Variables of every plot_ function of a project
+    return [e.replace('plot_', '', 1) for e in dir(obj.project) if e.startswith('plot_') and callable(getattr(obj.project, str(e)))]
+
+def save_figures(var, figures, outdir, fmt='png', dpi=None):
+    '''
+    Saves the figures drawn by plot_<var> as <outdir>/<var>.<fmt> (numbered if several)
+    Returns the saved paths
+    '''
+    paths = figure_paths(var, len(figures), outdir, fmt)
+
+    for fig, path in zip(figures, paths):
+        fig.savefig(path, format=fmt, dpi=dpi)
+
+    return paths
+
+def figure_paths(var, count, outdir, fmt):
+    # <outdir>/<var>.<fmt>, numbered when plot_<var> draws several figures
+    if count == 1:
+        return [os.path.join(outdir, '%s.%s' % (var, fmt))]
+
+    return [os.path.join(outdir, '%s-%d.%s' % (var, i + 1, fmt)) for i in range(count)]
+
+def batch_plot(vars, outdir='assets', fmt='png', dpi=None, processes=None):
+    '''
+    Renders plot functions to <outdir>/<variable>.<fmt> without a display
+
+    vars: Plot variables; 'all' selects every plot_ function of the project
+    dpi: Resolution of the saved images (defaults to matplotlib's savefig.dpi)
+    processes: Pool size (defaults to the number of cores; 1 renders in-process)
+    '''
+    if selected_project is None:
+        print('No selected project')
+        usage()
+        return False
+
+    obj = project_module(selected_project)
+
+    if obj is None:
+        return False
+
+    if 'all' in vars:
+        vars = plot_names(obj)
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    processes = max(1, min(processes, len(vars)))
+    tasks     = [(var, outdir, fmt, dpi) for var in vars]
+    failed    = 0
+
+    if processes == 1:
+        backend = plt.get_backend()
+
+        try:
+            _batch_init(selected_project)
+
+            for task in tasks:
+                failed += _report(*_batch_render(task))
+        finally:
+            plt.switch_backend(backend)
+    else:
+        threads = max(1, (os.cpu_count() or 1) // processes)
+        pool    = multiprocessing.Pool(processes, initializer=_batch_init, initargs=(selected_project, threads))
+
+        try:
+            for result in pool.imap_unordered(_batch_render, tasks):
+                failed += _report(*result)
+        finally:
+            pool.close()
+            pool.join()
+
+    print('Rendered %d of %d plots to %s' % (len(tasks) - failed, len(tasks), outdir))
+
+    return failed == 0
+
+def get_var(var, name=None):
+    if name is None:
+        name = selected_project
+
+    if name is not None:
+        obj = project_module(name)
+
+        if obj is None:
+            return False
 
         if str(var) == 'all':
 
@@ -183,9 +584,15 @@ def get_var(var):
         print('No selected project')
         usage()
 
-def run_func(var):
-    if selected_project is not None:
-        obj = current_projects[selected_project]
+def run_func(var, name=None):
+    if name is None:
+        name = selected_project
+
+    if name is not None:
+        obj = project_module(name)
+
+        if obj is None:
+            return False
 
         if str(var) == 'all': # Are you sure about that?
 
@@ -202,33 +609,28 @@ def run_func(var):
         print('No selected project')
         usage()
 
-def list():
+def list(name=None):
+    if name is None:
+        name = selected_project
+
     print('Available projects:')
 
     for s in PROJECTS:
-        if selected_project is not None and s == selected_project:
+        if name is not None and s == name:
             print('> * %s' % (s))
         else:
             print('  * %s' % (s))
 
-    if selected_project is not None:
-        obj   = current_projects[selected_project]
-
-        gets  = []
-        plots = []
-        runs  = []
+    if name is not None:
+        found = targets(name)
 
-        for e in dir(obj.project):
-            if e.startswith('get_') and callable(getattr(obj.project, str(e))):
-                gets.append(str(e).replace('get_', ''))
-            elif e.startswith('plot_') and callable(getattr(obj.project, str(e))):
-                plots.append(str(e).replace('plot_', ''))
-            elif e.startswith('run_') and callable(getattr(obj.project, str(e))):
-                runs.append(str(e).replace('run_', ''))
+        gets  = found['get']
+        plots = found['plot']
+        runs  = found['run']
 
         if len(gets) != 0 or len(plots) != 0 or len(runs) != 0:
             print('----------------------------------')
-            print('Functions for \'%s\'' % (selected_project))
+            print('Functions for \'%s\'' % (name))
 
             if len(gets) != 0:
                 print('Gets:')
@@ -248,20 +650,402 @@ def list():
                 for r in runs:
                     print ('  * %s' % (r))
 
+#### Daemon ####
+# A resident process keeps projects (and their pupil caches) loaded and answers
+# command lines sent by thin clients over a Unix domain socket. Each message is
+# an 8-byte length followed by JSON; figures travel as rendered image bytes (base64),
+# never as pickles. The socket lives in a directory only its owner can enter, and
+# clients refuse sockets owned by anyone else.
+SOCKET_NAME = 'datamaster.sock'
+
+def socket_path():
+    '''
+    $DATAMASTER_SOCKET, else the socket in the user's runtime directory ($XDG_RUNTIME_DIR,
+    or a private datamaster-<uid> directory under the temporary directory)
+    Returns None if that directory is not private to the user
+    '''
+    if 'DATAMASTER_SOCKET' in os.environ:
+        return os.environ['DATAMASTER_SOCKET']
+
+    if not hasattr(os, 'getuid'): # No Unix sockets anyway
+        return SOCKET_NAME
+
+    base = os.environ.get('XDG_RUNTIME_DIR')
+
+    if not base or not os.path.isdir(base):
+        base = os.path.join(tempfile.gettempdir(), 'datamaster-%d' % (os.getuid()))
+
+        try:
+            os.mkdir(base, 0o700)
+        except FileExistsError:
+            pass
+
+    st = os.lstat(base)
+
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        print('%s is not a private directory of this user; not using a daemon' % (base))
+        return None
+
+    return os.path.join(base, SOCKET_NAME)
+
+_projects_lock = threading.Lock() # Guards loading and reloading of projects
+_pyplot_lock   = threading.Lock() # pyplot's figure list is global, so plots run one at a time
+_output        = threading.local() # Buffer of the request handled by the current thread
+
+class _ThreadOutput(object):
+    '''
+    * Internal *
+
+    Stand-in for sys.stdout that sends prints made while handling a request back to its client
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        buffer = getattr(_output, 'buffer', None)
+
+        if buffer is not None:
+            return buffer.write(text)
+
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+def _send(sock, obj):
+    data = json.dumps(obj).encode('utf-8')
+    sock.sendall(struct.pack('>Q', len(data)) + data)
+
+def _recvall(sock, n):
+    chunks = []
+
+    while n > 0:
+        chunk = sock.recv(min(n, 1 << 20))
+
+        if not chunk:
+            return None
+
+        chunks.append(chunk)
+        n -= len(chunk)
+
+    return b''.join(chunks)
+
+def _recv(sock):
+    head = _recvall(sock, 8)
+
+    if head is None:
+        return None
+
+    data = _recvall(sock, struct.unpack('>Q', head)[0])
+
+    if data is None:
+        return None
+
+    try:
+        return json.loads(data.decode('utf-8'))
+    except ValueError: # Not a message of ours
+        return None
+
+def _connect(path):
+    '''
+    * Internal *
+
+    Connected socket to the daemon at path, or None if nothing (of this user's) is listening
+    '''
+    if path is None or not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+        return None
+
+    st = os.stat(path)
+
+    if not stat.S_ISSOCK(st.st_mode) or (hasattr(os, 'getuid') and st.st_uid != os.getuid()):
+        print('%s is not a socket of this user; ignoring it' % (path))
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    return sock
+
+def _remote_plot(var, name, fmt='png', dpi=None):
+    '''
+    * Internal *
+
+    Draws plot_<var> off-screen and returns its figures as base64 image files in fmt
+    '''
+    with _pyplot_lock:
+        plt.close('all')
+
+        try:
+            if not plot_var(var, name):
+                return []
+
+            images = []
+
+            for num in plt.get_fignums():
+                data = io.BytesIO()
+                plt.figure(num).savefig(data, format=fmt, dpi=dpi)
+                images.append(base64.b64encode(data.getvalue()).decode('ascii'))
+
+            return images
+        finally:
+            plt.close('all')
+
+def serve_request(args, plots):
+    '''
+    Runs one client command line inside the daemon
+
+    The project is selected per request (-s), so concurrent clients do not
+    interfere. Figures drawn by -p are appended to plots as (variable, [images]), in
+    the --format of the request if it saves them (-o), else as PNG to be shown.
+    Returns True if the client asked the daemon to stop.
+    '''
+    try:
+        opts, args = getopt.getopt(args, SHORT_OPTS, LONG_OPTS)
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        return False
+
+    try:
+        outdir, fmt, dpi, processes = batch_options(opts)
+    except ValueError as err:
+        print(str(err))
+        return False
+
+    profiler, trace = profile_options(opts)
+    image           = (fmt, dpi) if outdir is not None else ('png', None)
+
+    try:
+        return _serve_opts(opts, plots, profiler, image)
+    finally:
+        if profiler is not None:
+            profiler.report(trace)
+
+def _serve_opts(opts, plots, profiler, image):
+    '''
+    * Internal *
+
+    Option loop of serve_request
+    '''
+    name = None
+
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            return False
+
+        elif opt in ('-l', '--list'):
+            list(name)
+            return False
+
+        elif opt in ('-v', '--version'):
+            current_version()
+            return False
+
+        elif opt in ('-s', '--select'):
+            with _projects_lock:
+                if arg in current_projects or fetch_project(arg, False) is not None:
+                    name = arg
+
+        elif opt in ('-r', '--reload'):
+            if name is None:
+                print('No selected project to reload')
+                return False
+
+            with _projects_lock:
+                if fetch_project(name, True) is None:
+                    return False
+
+        elif opt in ('-p', '--plot'):
+            if name is None:
+                print('No selected project')
+                return False
+
+            for v in arg.split(','):
+                for var in (plot_names(project_module(name)) if v == 'all' else [v] if v else []):
+                    plots.append((var, profiled(profiler, 'plot %s' % (var), name, _remote_plot, var, name, *image)))
+
+        elif opt in ('-g', '--get'):
+            profiled(profiler, 'get %s' % (arg), name, get_var, arg, name)
+
+        elif opt in ('-x', '--run'):
+            profiled(profiler, 'run %s' % (arg), name, run_func, arg, name)
+
+        elif opt == '--stop':
+            print('Stopping daemon')
+            return True
+
+    return False
+
+class _DaemonHandler(socketserver.BaseRequestHandler):
+    '''
+    * Internal *
+
+    Answers one command line per connection, each in its own thread
+    '''
+
+    def handle(self):
+        request = _recv(self.request)
+
+        if request is None:
+            return
+
+        _output.buffer = io.StringIO()
+        plots = []
+        stop  = False
+
+        try:
+            stop = serve_request(request['args'], plots)
+        except Exception as err:
+            print(str(err))
+        finally:
+            output = _output.buffer.getvalue()
+            _output.buffer = None
+
+        _send(self.request, {'output': output, 'plots': plots})
+
+        if stop:
+            # shutdown() blocks until serve_forever returns; let this handler finish first
+            threading.Thread(target=self.server.shutdown).start()
+
+def daemon(path, preload=()):
+    '''
+    Serves command lines on the Unix socket at path until stopped
+
+    preload: Projects to load before accepting requests
+    '''
+    if not hasattr(socket, 'AF_UNIX'):
+        print('Unix domain sockets are not available on this platform')
+        return
+
+    sock = _connect(path)
+
+    if sock is not None:
+        sock.close()
+        print('A daemon is already listening on %s' % (path))
+        return
+
+    if os.path.exists(path):
+        os.remove(path) # Left over from a daemon that did not exit cleanly
+
+    plt.switch_backend('Agg') # Figures are drawn off-screen and shown by the client
+
+    for name in preload:
+        fetch_project(name, False)
+
+    umask  = os.umask(0o177)
+
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, _DaemonHandler)
+    finally:
+        os.umask(umask)
+
+    server.daemon_threads = True
+    stdout     = sys.stdout
+    sys.stdout = _ThreadOutput(stdout)
+
+    # SIGTERM and SIGINT both end serve_forever through the finally below
+    signal.signal(signal.SIGTERM, exit_handle)
+    signal.signal(signal.SIGINT, exit_handle)
+
+    print('DataMaster daemon listening on %s' % (path))
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        sys.stdout = stdout
+
+        if os.path.exists(path):
+            os.remove(path)
+
+def remote(args, path):
+    '''
+    Forwards a command line to a running daemon
+    Figures come back and are shown, or saved if -o was given
+    Returns False if no daemon is listening on path
+    '''
+    sock = _connect(path)
+
+    if sock is None:
+        return False
+
+    try:
+        _send(sock, {'args': args})
+        reply = _recv(sock)
+    finally:
+        sock.close()
+
+    if reply is None:
+        print('The daemon closed the connection')
+        return True
+
+    sys.stdout.write(reply['output'])
+
+    if len(reply['plots']) == 0:
+        return True
+
+    try:
+        outdir, fmt, dpi, processes = batch_options(getopt.getopt(args, SHORT_OPTS, LONG_OPTS)[0])
+    except (getopt.GetoptError, ValueError) as err:
+        print(str(err))
+        return True
+
+    if outdir is not None:
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+
+        for var, images in reply['plots']:
+            paths = figure_paths(var, len(images), outdir, fmt)
+
+            for path, data in zip(paths, images):
+                with open(path, 'wb') as f:
+                    f.write(base64.b64decode(data))
+
+            _report(var, paths, None)
+    else:
+        for var, images in reply['plots']:
+            for data in images:
+                pixels = plt.imread(io.BytesIO(base64.b64decode(data)), format='png')
+                fig    = plt.figure(var, figsize=(pixels.shape[1] / 100., pixels.shape[0] / 100.), dpi=100)
+                fig.figimage(pixels)
+
+        plt.show()
+        plt.close('all')
+
+    return True
+
 def current_version():
     print('DataMaster version %s' % VERSION)
 
 def usage():
     current_version()
-    print('Usage: datamaster.py -s <name> [-g, -p] <data name>')
+    print('Usage: datamaster.py -s <name> [-g, -p] <data name> [-o <dir>]')
     print('\nCommands:\n  -h, --help: Prints out this help section')
     print('  -l, --list: Lists all the available projects and, if a project is selected, all available gets and plots')
     print('  -s, --select <name>: Selects project to compute data from')
-    print('  -r, --reload: Reloads the selected project from file')
+    print('  -r, --reload: Reloads the changed modules of the selected project (and the modules importing them)')
     print('  -p, --plot <variable>: Calls a plotting function of the form \"plot_<variable>\"')
+    print('  -o, --output <dir>: Saves the plots given with -p to <dir> instead of showing them (\"all\" renders every plot)')
+    print('      --format <ext>: Image format for -o (default png)')
+    print('      --dpi <dpi>: Image resolution for -o')
+    print('  -j, --jobs <n>: Number of processes rendering plots for -o (default: number of cores)')
+    print('      --profile: Reports wall/CPU time, peak memory and per-stage timings of each -p, -g and -x')
+    print('      --profile-out <file>: Also writes the profile as a JSON (or .csv) trace')
     print('  -g, --get <variable>: Prints out a value from function of the form \"get_<variable>\"')
     print('  -x, --run <variable>: Runs a custom function of the form \"run_<variable>\"')
     print('  -e, --exit: Explicit command to exit from DataMaster CLI')
+    print('\nDaemon:\n  --daemon: Keeps projects loaded and serves commands on a Unix socket (-s preloads projects)')
+    print('  --socket <path>: Socket of the daemon (default $DATAMASTER_SOCKET, else %s in $XDG_RUNTIME_DIR or a private temporary directory)' % (SOCKET_NAME))
+    print('  --local: Runs the command in this process even if a daemon is listening')
+    print('  --stop: Stops the daemon')
+    print('  Command lines are sent to a listening daemon automatically')
 
 def cli():
     legacy = False
@@ -286,15 +1070,192 @@ def exit_handle(sig, frame):
     print('\nExiting...')
     sys.exit(0)
 
+#### Profiling ####
+_profile_lock = threading.Lock() # tracemalloc and the instrument() recorder are process-wide: one profiled command at a time
+
+class Profiler(object):
+    '''
+    Wall time, CPU time and peak traced memory of each dispatched command
+
+    While a command runs, the profiler is also installed as the recorder of the
+    project's instrument() hook (if it has one), so the stage timings of pupils and
+    random fields (render.mask, render.exp, psf.fft, randomfield.noise, ...) are
+    collected per command. Stages may nest: render.phase includes randomfield.*.
+    CPU time is that of the whole process, including FFT threads.
+
+    Profiled commands run one at a time, even when the daemon serves them on
+    several threads; the peak is n/a if something else stopped tracemalloc meanwhile.
+    '''
+
+    FIELDS = ['command', 'stage', 'calls', 'wall', 'cpu', 'peak']
+
+    def __init__(self):
+        self.rows    = []
+        self._stages = {}
+
+    def record(self, stage, seconds):
+        entry = self._stages.setdefault(stage, [0, 0.])
+        entry[0] += 1
+        entry[1] += seconds
+
+    def run(self, label, obj, func, *args):
+        '''
+        Calls func(*args) and records it under label; obj is the project module it belongs to
+        '''
+        hook = getattr(getattr(obj, 'project', None), 'instrument', None)
+
+        if not callable(hook):
+            hook = None
+
+        with _profile_lock:
+            started = not tracemalloc.is_tracing()
+
+            if started:
+                tracemalloc.start()
+            else:
+                tracemalloc.reset_peak()
+
+            base = tracemalloc.get_traced_memory()[0]
+
+            self._stages = {}
+            previous     = hook(self) if hook is not None else None
+
+            wall = time.perf_counter()
+            cpu  = time.process_time()
+
+            try:
+                return func(*args)
+            finally:
+                wall = time.perf_counter() - wall
+                cpu  = time.process_time() - cpu
+                peak = None
+
+                if tracemalloc.is_tracing():
+                    peak = tracemalloc.get_traced_memory()[1] - base
+
+                    if started:
+                        tracemalloc.stop()
+
+                if hook is not None:
+                    hook(previous)
+
+                self.rows.append({'command': label, 'stage': None, 'calls': 1, 'wall': wall, 'cpu': cpu, 'peak': peak})
+
+                for stage, (calls, seconds) in sorted(self._stages.items()):
+                    self.rows.append({'command': label, 'stage': stage, 'calls': calls, 'wall': seconds, 'cpu': None, 'peak': None})
+
+    def table(self):
+        print('%-24s %-22s %6s %10s %10s %11s' % ('command', 'stage', 'calls', 'wall [s]', 'cpu [s]', 'peak [MiB]'))
+
+        for row in self.rows:
+            peak = ''
+
+            if row['peak'] is not None:
+                peak = '%.1f' % (row['peak'] / 2.**20)
+            elif row['stage'] is None:
+                peak = 'n/a'
+
+            print('%-24s %-22s %6d %10.4f %10s %11s' % (row['command'] if row['stage'] is None else '',
+                                                         row['stage'] or '',
+                                                         row['calls'],
+                                                         row['wall'],
+                                                         '%.4f' % (row['cpu']) if row['cpu'] is not None else '',
+                                                         peak))
+
+    def dump(self, path):
+        '''
+        Writes the trace as CSV if path ends in .csv, else as JSON (peak is in bytes, empty or null if n/a)
+        '''
+        with open(path, 'w') as f:
+            if path.lower().endswith('.csv'):
+                writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+                writer.writeheader()
+                writer.writerows(self.rows)
+            else:
+                json.dump(self.rows, f, indent=2)
+
+    def report(self, path=None):
+        if len(self.rows) == 0:
+            return
+
+        self.table()
+
+        if path is not None:
+            self.dump(path)
+            print('Profile written to %s' % (path))
+
+def profile_options(opts):
+    '''
+    (Profiler or None, trace path or None) from parsed options
+    '''
+    profile = False
+    path    = None
+
+    for opt, arg in opts:
+        if opt == '--profile':
+            profile = True
+        elif opt == '--profile-out':
+            profile = True
+            path    = arg
+
+    return (Profiler() if profile else None), path
+
+def profiled(profiler, label, name, func, *args):
+    # Runs func(*args), through the profiler if there is one
+    if profiler is None:
+        return func(*args)
+
+    # Import the project first so its stage hook is installed for the very first command
+    obj = project_module(name) if name is not None else None
+
+    return profiler.run(label, obj, func, *args)
+
+SHORT_OPTS = 'hlvs:rp:g:x:eo:j:'
+LONG_OPTS  = ['help', 'list', 'version', 'reload', 'select=', 'plot=', 'get=', 'run=', 'exit',
+              'output=', 'format=', 'dpi=', 'jobs=', 'daemon', 'socket=', 'local', 'stop',
+              'profile', 'profile-out=']
+
+def batch_options(opts):
+    '''
+    (output directory, format, dpi, processes) from parsed options
+    Batch settings apply to every -p, wherever they appear
+    '''
+    outdir    = None
+    fmt       = 'png'
+    dpi       = None
+    processes = None
+
+    for opt, arg in opts:
+        if opt in ('-o', '--output'):
+            outdir = arg
+        elif opt == '--format':
+            fmt = arg.lstrip('.')
+        elif opt == '--dpi':
+            dpi = float(arg)
+        elif opt in ('-j', '--jobs'):
+            processes = int(arg)
+
+    return outdir, fmt, dpi, processes
+
 def handle_args(args):
     try:
-        opts, args = getopt.getopt(args, 'hlvs:rp:g:x:e', ['help', 'list', 'version', 'reload', 'select=', 'plot=', 'get=', 'run=', 'exit'])
+        opts, args = getopt.getopt(args, SHORT_OPTS, LONG_OPTS)
     except getopt.GetoptError as err:
         print(str(err))
         usage()
         return
 
     plotting = False
+    batch    = []
+
+    try:
+        outdir, fmt, dpi, processes = batch_options(opts)
+    except ValueError as err:
+        print(str(err))
+        usage()
+        return
+
+    profiler, trace = profile_options(opts)
 
     for opt, arg in opts:
         if opt in ('-h', '--help'):
@@ -320,22 +1281,37 @@ def handle_args(args):
                 return
 
         elif opt in ('-p', '--plot'):
-            if plot_var(arg) and plotting is False:
+            if outdir is not None:
+                batch.extend(v for v in arg.split(',') if v)
+            elif profiled(profiler, 'plot %s' % (arg), selected_project, plot_var, arg) and plotting is False:
                 plotting = True
 
         elif opt in ('-g', '--get'):
-            get_var(arg)
+            profiled(profiler, 'get %s' % (arg), selected_project, get_var, arg)
 
         elif opt in ('-x', '--run'):
-            run_func(arg)
+            profiled(profiler, 'run %s' % (arg), selected_project, run_func, arg)
 
         elif opt in ('-e', '--exit'):
             print('\nExiting...')
             sys.exit(0)
 
+        elif opt in ('-o', '--output', '--format', '--dpi', '-j', '--jobs', '--daemon', '--socket', '--local', '--profile', '--profile-out'):
+            pass
+
+        elif opt == '--stop':
+            print('No daemon is listening')
+
         else:
             usage()
 
+    if len(batch) != 0:
+        # Stages run in the pool's processes are not collected; -j 1 keeps them in this one
+        profiled(profiler, 'batch %s' % (','.join(batch)), selected_project, batch_plot, batch, outdir, fmt, dpi, processes)
+
+    if profiler is not None:
+        profiler.report(trace)
+
     if plotting:
         plt.show()
         plt.close('all')
@@ -349,7 +1325,32 @@ def main(argv):
         # register sigkill event and start looping CLI
         signal.signal(signal.SIGINT, exit_handle)
         cli()
-    else:
+        return
+
+    try:
+        opts = getopt.getopt(argv, SHORT_OPTS, LONG_OPTS)[0]
+    except getopt.GetoptError:
+        opts = [] # handle_args reports the error
+
+    path  = None
+    local = False
+    serve = False
+
+    for opt, arg in opts:
+        if opt == '--socket':
+            path = arg
+        elif opt == '--local':
+            local = True
+        elif opt == '--daemon':
+            serve = True
+
+    if path is None and (serve or not local):
+        path = socket_path()
+
+    if serve:
+        if path is not None:
+            daemon(path, preload=[arg for opt, arg in opts if opt in ('-s', '--select')])
+    elif local or not remote(argv, path):
         handle_args(argv)
 
 if __name__ == '__main__':
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+# Benchmarks of pupil rendering and PSF generation
+#
+#   python -m src.benchmark run [-o results.json] [--samples 256,512] [--padscale 1,2]
+#                               [--pupils Simple,Model] [--targets render,psf] [--repeat 5] [--quick]
+#   python -m src.benchmark compare baseline.json results.json [--threshold 0.1]
+#
+# compare exits with status 1 if any case got slower than the threshold allows.
+
+import datetime
+import getopt
+import json
+import os
+import platform
+import subprocess
+import sys
+from time import perf_counter
+
+import numpy as np
+import scipy
+
+from .simplepf import SimplePupilFunction
+from .simplegausspf import DirtySimplePupilFunction
+from .cassegrainpf import CassegrainPupilFunction
+from .cassegausspf import DirtyCassegrainPupilFunction
+from .squarepf import SquarePupilFunction
+from .modelpf import ModelPupilFunction
+from .gaussianrndf import GaussianRandomField
+from .fftbackend import backend
+
+PI     = np.pi
+TWO_PI = 2. * PI
+
+SEED = 0 # Seed of every phase screen, so each run times the same work
+
+# (name, class, settings besides samples and padscale); mirrors the pupils of project.py
+PUPILS = [
+    ('Simple',          SimplePupilFunction,          dict(diameter=6.5)),
+    ('DirtySimple',     DirtySimplePupilFunction,     dict(diameter=6.5, pk=ModelPupilFunction.atm_Pk, seed=SEED)),
+    ('Cassegrain',      CassegrainPupilFunction,      dict(diameter=6.5, b=1.5)),
+    ('DirtyCassegrain', DirtyCassegrainPupilFunction, dict(diameter=6.5, b=1.5, pk=ModelPupilFunction.atm_Pk, seed=SEED)),
+    ('Square',          SquarePupilFunction,          dict(diameter=6.5)),
+    ('Model',           ModelPupilFunction,           dict(diameter=.250, b=.110, seed=SEED)),
+    ('Model (no turb)', ModelPupilFunction,           dict(diameter=.250, b=.110, turbulence=False)),
+]
+
+TARGETS  = ['render', 'psf', 'psf_range', 'randomfield']
+SAMPLES  = [256, 512, 1024, 2048, 4096]
+PADSCALE = [1., 2., 4.]
+
+k_green = TWO_PI / (550e-9)
+k_range = TWO_PI / np.linspace(400e-9, 700e-9, 10)
+
+def environment():
+    '''
+    Description of the machine and libraries a run was made with
+    '''
+    env = {
+        'date':     datetime.datetime.now().isoformat(),
+        'host':     platform.node(),
+        'platform': platform.platform(),
+        'machine':  platform.machine(),
+        'cpus':     os.cpu_count(),
+        'python':   platform.python_version(),
+        'numpy':    np.__version__,
+        'scipy':    scipy.__version__,
+        'fft':      backend.name,
+        'commit':   None,
+    }
+
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    return env
+
+def _workload(target, pupil):
+    '''
+    * Internal *
+
+    The call timed for target on a fresh pupil
+    '''
+    if target == 'render':
+        return lambda: pupil.render(k_green, filtering=True)
+    elif target == 'psf':
+        return lambda: pupil.psf(k=k_green, filtering=True)
+    elif target == 'psf_range':
+        from .project import psf_range
+        return lambda: psf_range(pupil, k_range)
+    elif target == 'randomfield':
+        grf = GaussianRandomField(pupil, dtype=np.float64, rng=np.random.default_rng(SEED))
+        return lambda: grf.randomfield(ModelPupilFunction.atm_Pk)
+
+    raise ValueError('Unknown benchmark target \'%s\'' % (target))
+
+def measure(cls, settings, target, samples, padscale, repeat=5):
+    '''
+    Times one case; 'cold' is the first call on a fresh pupil (meshes, aperture and
+    screen included), 'best' and 'median' are over the repeat calls that follow
+    '''
+    result = {'target': target, 'samples': samples, 'padscale': padscale, 'repeat': repeat}
+
+    try:
+        pupil = cls(samples=samples, padscale=padscale, **settings)
+        func  = _workload(target, pupil)
+
+        start = perf_counter()
+        func()
+        result['cold'] = perf_counter() - start
+
+        times = []
+
+        for i in range(repeat):
+            start = perf_counter()
+            func()
+            times.append(perf_counter() - start)
+
+        result['best']   = min(times) if times else result['cold']
+        result['median'] = float(np.median(times)) if times else result['cold']
+    except Exception as err:
+        result['error'] = '%s: %s' % (type(err).__name__, err)
+
+    return result
+
+def run(pupils=None, targets=None, samples=None, padscale=None, repeat=5, path=None):
+    '''
+    Benchmarks every combination and returns (and optionally writes) the results
+
+    pupils: Names from PUPILS (defaults to all); targets: from TARGETS
+    '''
+    pupils   = [p for p in PUPILS if pupils is None or p[0] in pupils]
+    targets  = targets or TARGETS
+    samples  = samples or SAMPLES
+    padscale = padscale or PADSCALE
+
+    results = {'environment': environment(), 'results': []}
+
+    for name, cls, settings in pupils:
+        for n in samples:
+            for s in padscale:
+                for target in targets:
+                    result = measure(cls, settings, target, n, s, repeat)
+                    result['pupil'] = name
+
+                    results['results'].append(result)
+
+                    if 'error' in result:
+                        print('%-16s %-12s %5d %4.1f  failed: %s' % (name, target, n, s, result['error']))
+                    else:
+                        print('%-16s %-12s %5d %4.1f  cold %9.4f s  median %9.4f s' % (name, target, n, s, result['cold'], result['median']))
+
+    if path is not None:
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+        print('Results written to %s' % (path))
+
+    return results
+
+def _key(result):
+    return (result['pupil'], result['target'], result['samples'], float(result['padscale']))
+
+def compare(baseline, current, threshold=0.1):
+    '''
+    Compares median times of two runs (dicts or paths to JSON results)
+    Cases more than threshold (relative) slower are flagged, as are cases timed in
+    the baseline that fail in the new run; returns how many were
+    '''
+    runs = []
+
+    for r in (baseline, current):
+        if not isinstance(r, dict):
+            with open(r) as f:
+                r = json.load(f)
+
+        runs.append(r)
+
+    old    = dict((_key(r), r) for r in runs[0]['results'] if 'median' in r)
+    new    = dict((_key(r), r) for r in runs[1]['results'] if 'median' in r)
+    failed = dict((_key(r), r) for r in runs[1]['results'] if 'error' in r)
+
+    for r in runs:
+        env = r.get('environment', {})
+        print('# %s  %s  %s cpus  numpy %s  %s' % (env.get('commit'), env.get('host'), env.get('cpus'), env.get('numpy'), env.get('date')))
+
+    print('%-16s %-12s %5s %4s %11s %11s %7s' % ('pupil', 'target', 'N', 'pad', 'base [s]', 'new [s]', 'ratio'))
+
+    regressions = 0
+
+    for key in sorted(set(old) & set(new)):
+        ratio = new[key]['median'] / old[key]['median'] if old[key]['median'] > 0. else float('inf')
+        flag  = ''
+
+        if ratio > 1. + threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif ratio < 1. - threshold:
+            flag = 'faster'
+
+        print('%-16s %-12s %5d %4.1f %11.4f %11.4f %7.2f  %s' % (key[0], key[1], key[2], key[3], old[key]['median'], new[key]['median'], ratio, flag))
+
+    for key in sorted(set(old) & set(failed)):
+        regressions += 1
+
+        print('%-16s %-12s %5d %4.1f %11.4f %11s %7s  REGRESSION (%s)' % (key[0], key[1], key[2], key[3], old[key]['median'], 'failed', '', failed[key]['error']))
+
+    missing = sorted(set(old) - set(new) - set(failed))
+
+    if len(missing) != 0:
+        print('%d baseline cases missing from the new run' % (len(missing)))
+
+    print('%d regressions (threshold %.0f%%)' % (regressions, 100. * threshold))
+
+    return regressions
+
+def usage():
+    print('Usage: python -m src.benchmark run [-o <file>] [--samples <n,...>] [--padscale <s,...>] [--pupils <name,...>]')
+    print('                                   [--targets <name,...>] [--repeat <n>] [--quick]')
+    print('       python -m src.benchmark compare <baseline> <results> [--threshold <fraction>]')
+    print('Pupils: %s' % (', '.join(p[0] for p in PUPILS)))
+    print('Targets: %s' % (', '.join(TARGETS)))
+
+def main(argv):
+    if len(argv) == 0 or argv[0] not in ('run', 'compare'):
+        usage()
+        return 2
+
+    try:
+        opts, args = getopt.gnu_getopt(argv[1:], 'ho:', ['help', 'samples=', 'padscale=', 'pupils=', 'targets=', 'repeat=', 'quick', 'threshold='])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        return 2
+
+    settings  = {'path': None}
+    threshold = 0.1
+    quick     = False
+
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            return 0
+        elif opt == '-o':
+            settings['path'] = arg
+        elif opt == '--samples':
+            settings['samples'] = [int(v) for v in arg.split(',')]
+        elif opt == '--padscale':
+            settings['padscale'] = [float(v) for v in arg.split(',')]
+        elif opt == '--pupils':
+            settings['pupils'] = arg.split(',')
+        elif opt == '--targets':
+            settings['targets'] = arg.split(',')
+        elif opt == '--repeat':
+            settings['repeat'] = int(arg)
+        elif opt == '--quick':
+            quick = True
+        elif opt == '--threshold':
+            threshold = float(arg)
+
+    if quick:
+        # Small grid for a sanity check; explicit options still win
+        settings.setdefault('samples', [256, 512])
+        settings.setdefault('padscale', [2.])
+        settings.setdefault('repeat', 3)
+
+    if argv[0] == 'run':
+        run(**settings)
+        return 0
+
+    if len(args) != 2:
+        usage()
+        return 2
+
+    return 1 if compare(args[0], args[1], threshold) else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -9,10 +9,16 @@ class CassegrainPupilFunction(AbstractPupilFunction):
     - W(x, y) = 0 for no phase shifting
     '''
 
+    maskopts = ('b',)
+
     def pFunc(self, x, y):
-        pass1 = np.where((x)**2 + (y)**2 <= (self.radius())**2, 1., 0.)
-        pass2 = np.where((x)**2 + (y)**2 > ((self.opts['b'] / 2.)**2), pass1, 0.)
+        r2    = self.radius2(x, y)
+        pass1 = np.where(r2 <= (self.radius())**2, 1., 0.)
+        pass2 = np.where(r2 > ((self.opts['b'] / 2.)**2), pass1, 0.)
         return pass2
 
+    def isSymmetric(self):
+        return True
+
     def wFunc(self, x, y):
-        return np.zeros((self.samples, self.samples))
+        return 0.
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import numpy as np
+
+#### Layout ####
+# A cube is a directory holding
+#   cube.npy   - (slices, ny, nx) array, written and read through np.memmap
+#   meta.json  - pupil class, settings, opts, k values, seed and anything else passed in
+
+CUBE_FILE = 'cube.npy'
+META_FILE = 'meta.json'
+
+def jsonable(v):
+    '''
+    Best-effort JSON form of a setting; functions are stored by name
+    '''
+    if isinstance(v, (bool, int, float, str)) or v is None:
+        return v
+    elif isinstance(v, (np.integer, np.floating)):
+        return v.item()
+    elif isinstance(v, np.ndarray):
+        return v.tolist()
+    elif isinstance(v, (list, tuple)):
+        return [jsonable(e) for e in v]
+    elif isinstance(v, dict):
+        return dict((str(k), jsonable(e)) for k, e in v.items())
+    elif callable(v):
+        return '%s.%s' % (getattr(v, '__module__', '?'), getattr(v, '__qualname__', repr(v)))
+
+    return repr(v)
+
+def pupilmeta(pupil):
+    '''
+    Description of a pupil for cube headers (and cache keys)
+    '''
+    cls  = type(pupil)
+    meta = {
+        'class':  '%s.%s' % (cls.__module__, cls.__name__),
+        'dtype':  np.dtype(pupil.dtype).str,
+        'hankel': pupil.hankel,
+        'opts':   jsonable(pupil.opts),
+
+        'antialias': pupil.antialias,
+    }
+
+    # Every setting a cached entry can depend on (diameter, samples, ..., strut_width)
+    for deps in pupil._depends.values():
+        for dep in deps:
+            if dep != 'opts':
+                meta[dep] = jsonable(getattr(pupil, dep))
+
+    return meta
+
+class CubeWriter(object):
+    '''
+    Streams (ny, nx) slices into a memory-mapped cube on disk
+
+    path: Directory of the cube (created if needed)
+    shape: (slices, ny, nx)
+    meta: JSON-able header; 'ks' and 'seed' are conventional keys
+    '''
+
+    def __init__(self, path, shape, dtype=np.float64, meta=None):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.path  = path
+        self.shape = tuple(shape)
+        self.meta  = dict(meta or {})
+
+        self.meta['shape'] = list(self.shape)
+        self.meta['dtype'] = np.dtype(dtype).str
+
+        self._data = np.lib.format.open_memmap(os.path.join(path, CUBE_FILE), mode='w+', dtype=dtype, shape=self.shape)
+
+        with open(os.path.join(path, META_FILE), 'w') as f:
+            json.dump(jsonable(self.meta), f, indent=2)
+
+    @property
+    def data(self):
+        # The memory-mapped cube itself, for writing slices in place
+        return self._data
+
+    def write(self, i, data):
+        # i may be an index or a slice of consecutive slices
+        self._data[i] = data
+
+    def close(self):
+        if self._data is not None:
+            self._data.flush()
+            self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class PSFCube(object):
+    '''
+    Read-only, memory-mapped view of a cube written by CubeWriter
+
+    Indexing returns views into the file (no copy); reductions run chunk by chunk.
+    '''
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+
+        self.data = np.load(os.path.join(path, CUBE_FILE), mmap_mode=mode)
+
+        ks = self.meta.get('ks')
+        self.ks = np.asarray(ks) if ks is not None else None
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def window(self, slices=slice(None), rows=slice(None), cols=slice(None)):
+        '''
+        Zero-copy sub-cube; slices/rows/cols are slice objects
+        '''
+        return self.data[slices, rows, cols]
+
+    def _chunk(self, budget):
+        per = self.data.shape[1] * self.data.shape[2] * self.data.dtype.itemsize
+        return int(max(1, budget // per))
+
+    def sum(self, weights=None, budget=2**28):
+        '''
+        Weighted sum over the slice axis, reading about budget bytes at a time
+        '''
+        n     = len(self)
+        chunk = self._chunk(budget)
+        out   = np.zeros(self.data.shape[1:])
+
+        if weights is None:
+            weights = np.ones(n)
+        else:
+            weights = np.asarray(weights, dtype=float)
+
+            if weights.shape != (n,):
+                raise ValueError('weights must have one entry per slice')
+
+        for start in range(0, n, chunk):
+            out += np.tensordot(weights[start:start + chunk], self.data[start:start + chunk], axes=1)
+
+        return out
+
+    def mean(self, budget=2**28):
+        return self.sum(budget=budget) / len(self)
+
+def writecube(path, pupil, ks, filtering=False, noshift=False, seed=None, window=None, npix=None):
+    '''
+    Writes pupil.psf for each wavenumber in ks to a cube at path and returns a PSFCube
+
+    Slices are computed in batches of pupil.psf_cube (or psf for windows) and
+    streamed to disk, so the full cube never has to fit in memory. seed is only
+    recorded in the header (defaults to the pupil's 'seed' option).
+    '''
+    ks = np.atleast_1d(np.asarray(ks, dtype=float))
+    n  = pupil.samples if window is None else (npix or pupil.samples)
+
+    if seed is None:
+        seed = pupil.opts.get('seed')
+
+    meta = {
+        'pupil':     pupilmeta(pupil),
+        'ks':        ks,
+        'seed':      seed,
+        'filtering': filtering,
+        'noshift':   noshift,
+        'window':    window,
+    }
+
+    with CubeWriter(path, (len(ks), n, n), dtype=pupil.dtype, meta=meta) as writer:
+        if window is not None:
+            for i, k in enumerate(ks):
+                writer.write(i, pupil.psf(k=k, filtering=filtering, window=window, npix=npix))
+        else:
+            # Same batch size psf_cube would pick for itself
+            chunk = int(max(1, pupil.budget // (32 * pupil.samples**2)))
+
+            for start in range(0, len(ks), chunk):
+                writer.write(slice(start, start + chunk), pupil.psf_cube(ks[start:start + chunk], filtering=filtering, noshift=noshift))
+
+    return PSFCube(path)
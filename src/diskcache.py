@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+import types
+import numpy as np
+
+from .instrument import stage
+
+CACHE_VERSION = 2     # Bump when the numerics change so old entries are never reused
+STALE_TMP     = 3600. # Age (s) past which a leftover .tmp file is an orphan of a failed write
+
+_sources = {} # Source path -> (mtime_ns, size, SHA-256 of the file)
+
+def sourcedigest(modules):
+    '''
+    SHA-256 of the source files of modules, so cached results are not reused once the
+    code computing them changes; files are rehashed only when their mtime or size moves
+    '''
+    h = hashlib.sha256()
+
+    for module in sorted(modules, key=lambda m: m.__name__):
+        path = getattr(module, '__file__', None)
+
+        if path is None: # Built in
+            continue
+
+        st    = os.stat(path)
+        entry = _sources.get(path)
+
+        if entry is None or entry[:2] != (st.st_mtime_ns, st.st_size):
+            with open(path, 'rb') as f:
+                entry = (st.st_mtime_ns, st.st_size, hashlib.sha256(f.read()).hexdigest())
+
+            _sources[path] = entry
+
+        h.update(('%s:%s;' % (module.__name__, entry[2])).encode('utf-8'))
+
+    return h.hexdigest()
+
+class UncacheableKey(ValueError):
+    '''
+    Raised for keys with no stable description (objects known only by identity)
+    '''
+
+def _codedigest(code):
+    '''
+    * Internal *
+
+    Hash of a code object: its bytecode, names and constants (nested code included)
+    '''
+    h = hashlib.sha256(code.co_code)
+    h.update(repr(code.co_names).encode('utf-8'))
+
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            h.update(_codedigest(const).encode('utf-8'))
+        elif isinstance(const, frozenset):
+            h.update(repr(sorted(repr(e) for e in const)).encode('utf-8'))
+        else:
+            h.update(repr(const).encode('utf-8'))
+
+    return h.hexdigest()
+
+def canonical(v):
+    '''
+    JSON form of a key that identifies its value, not just its name
+
+    Arrays are hashed by their bytes. Functions carry a hash of their code, defaults
+    and closure values, so powerlaw(-1) and powerlaw(-3) closures get different keys.
+    Raises UncacheableKey for values known only by identity (their repr is an address).
+    '''
+    if isinstance(v, (bool, int, float, str)) or v is None:
+        return v
+    elif isinstance(v, (np.integer, np.floating, np.bool_)):
+        return v.item()
+    elif isinstance(v, np.ndarray):
+        if v.dtype.hasobject:
+            raise UncacheableKey('Object arrays have no stable bytes')
+
+        a = np.ascontiguousarray(v)
+
+        return {'array': hashlib.sha256(a.view(np.uint8).ravel() if a.ndim else a.tobytes()).hexdigest(),
+                'dtype': a.dtype.str, 'shape': list(a.shape)}
+    elif isinstance(v, (list, tuple)):
+        return [canonical(e) for e in v]
+    elif isinstance(v, dict):
+        return dict((str(k), canonical(e)) for k, e in v.items())
+    elif isinstance(v, types.FunctionType):
+        return {'function': '%s.%s' % (v.__module__, v.__qualname__),
+                'code':     _codedigest(v.__code__),
+                'defaults': canonical(v.__defaults__),
+                'closure':  [canonical(c.cell_contents) for c in (v.__closure__ or ())]}
+    elif isinstance(v, types.MethodType):
+        return {'method': canonical(v.__func__), 'self': canonical(v.__self__)}
+    elif callable(v) and getattr(v, '__qualname__', None) is not None:
+        # Builtins and ufuncs are fixed by their name
+        return '%s.%s' % (getattr(v, '__module__', '?'), v.__qualname__)
+
+    text = repr(v)
+
+    if ' at 0x' in text:
+        raise UncacheableKey('No stable description of %s' % (text))
+
+    return text
+
+class DiskCache(object):
+    '''
+    Content-addressed store of arrays on disk
+
+    Entries are .npy files named by the SHA-256 of their key (a description of how
+    the array was computed, see canonical). Loads are copy-on-write memory maps: lazy,
+    and writable without touching the stored entry.
+    When the total size exceeds maxbytes, the least recently used entries (by
+    modification time, refreshed on every hit) are evicted, along with the .tmp
+    files that failed writes left behind.
+    '''
+
+    def __init__(self, root, maxbytes=2**32):
+        self.root     = root
+        self.maxbytes = maxbytes
+
+        if not os.path.isdir(root):
+            os.makedirs(root, exist_ok=True) # Several processes may share a store
+
+        self._total = None # Lazily computed size of the store
+
+    def digest(self, key):
+        text = json.dumps(canonical([CACHE_VERSION, key]), sort_keys=True)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest + '.npy')
+
+    def get(self, key):
+        '''
+        Array stored under key, or None
+        '''
+        path = self._path(self.digest(key))
+
+        if not os.path.exists(path):
+            return None
+
+        try:
+            arr = np.load(path, mmap_mode='c')
+        except (IOError, ValueError): # Truncated or foreign file; drop it
+            self._remove(path)
+            return None
+
+        os.utime(path, None) # Mark as recently used
+
+        return arr
+
+    def put(self, key, arr):
+        path = self._path(self.digest(key))
+        arr  = np.asarray(arr)
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, arr)
+
+            old = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+            raise
+
+        if self._total is not None:
+            self._total += os.path.getsize(path) - old
+
+        self._evict()
+
+    def fetch(self, key, compute):
+        '''
+        Cached value for key, computing and storing it on a miss; keys without a
+        stable description (see canonical) are computed every time
+        '''
+        try:
+            self.digest(key)
+        except UncacheableKey:
+            return compute()
+
+        with stage('diskcache.get'):
+            arr = self.get(key)
+
+        if arr is None:
+            arr = compute()
+
+            with stage('diskcache.put'):
+                self.put(key, arr)
+
+        return arr
+
+    def _entries(self):
+        entries = []
+        stale   = time.time() - STALE_TMP
+
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith('.tmp'):
+                    # Writes in progress are recent; old ones were interrupted
+                    path = os.path.join(dirpath, name)
+
+                    try:
+                        if os.stat(path).st_mtime < stale:
+                            os.remove(path)
+                    except OSError: # Renamed or removed by its writer
+                        pass
+                elif name.endswith('.npy'):
+                    path = os.path.join(dirpath, name)
+
+                    try:
+                        st = os.stat(path)
+                    except OSError: # Evicted by another process
+                        continue
+
+                    entries.append((st.st_mtime, st.st_size, path))
+
+        return entries
+
+    def size(self):
+        if self._total is None:
+            self._total = sum(e[1] for e in self._entries())
+
+        return self._total
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+
+        if self._total is not None:
+            self._total -= size
+
+    def _evict(self):
+        if self.size() <= self.maxbytes:
+            return
+
+        for mtime, size, path in sorted(self._entries()):
+            if self._total <= self.maxbytes:
+                break
+
+            self._remove(path)
+
+    def clear(self):
+        for mtime, size, path in self._entries():
+            self._remove(path)
+
+        self._total = 0
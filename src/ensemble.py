@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+
+from .gaussianrndf import GaussianRandomField
+
+PI     = np.pi
+TWO_PI = 2. * PI
+
+#### Worker side ####
+# Views onto the shared arrays, set once per worker process by _attach
+_shared = {}
+
+def _attach(specs, pupil, k, filtering, noshift, workers):
+    '''
+    * Internal *
+
+    Pool initializer: maps the shared aperture and amplitude spectrum into this process,
+    next to its copy of the pupil
+    '''
+    _shared.clear()
+
+    for name, (shmname, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shmname)
+
+        _shared[name]          = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        _shared['_shm_' + name] = shm # Keep the mapping alive
+
+    _shared['pupil']     = pupil
+    _shared['workers']   = workers
+    _shared['k']         = k
+    _shared['filtering'] = filtering
+    _shared['noshift']   = noshift
+
+def _detach():
+    '''
+    * Internal *
+
+    Drops the views before closing the mappings they point into
+    '''
+    blocks = [v for n, v in _shared.items() if n.startswith('_shm_')]
+    _shared.clear()
+
+    for shm in blocks:
+        shm.close()
+
+def _shard(seeds):
+    '''
+    * Internal *
+
+    Sum of |FFT(P exp(-ikW))|² over one independent screen W per seed
+
+    Pupils are rendered and transformed by the pupil itself, so its precision,
+    antialiasing and FFT backend apply as in psf().
+    '''
+    pupil = _shared['pupil']
+    P     = _shared['aperture']
+    amp   = _shared['amplitude']
+    fft   = pupil.fft
+    nthr  = _shared['workers']
+    shape = P.shape
+
+    total = np.zeros(shape)
+
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+
+        # Same construction as GaussianRandomField.randomfield
+        noise  = fft.rfft2full(rng.standard_normal(size=shape), workers=nthr)
+        noise *= amp
+        W      = fft.fftshift(fft.ifft2(noise, workers=nthr, overwrite=True))
+
+        img       = pupil._render(_shared['k'], _shared['filtering'], W, pupil.workspace(shape, pupil.ctype, 'pupil'), P)
+        transform = fft.fft2(img, workers=nthr, overwrite=True)
+
+        total += transform.real**2.
+        total += transform.imag**2.
+
+    if not _shared['noshift']:
+        total = fft.fftshift(total)
+
+    return len(seeds), total
+
+#### Driver ####
+def longexposure(pupil, k, realizations, pk=None, processes=None, seed=None, shards=None, filtering=False, noshift=False, intensity=False):
+    '''
+    Long-exposure PSF averaged over independent turbulence screens
+
+    Realizations are sharded over a process pool. The aperture mask and amplitude
+    spectrum are placed once in shared memory instead of being pickled per task,
+    and partial sums are reduced as they arrive.
+
+    pupil: Pupil providing the aperture and Fourier mesh; a copy of it renders and
+           transforms the screens in each worker
+    k: Wavenumber of light (2π / λ)
+    realizations: Number of screens
+    pk: Power spectrum of the screens (defaults to opts['pk'], else von Karman)
+    processes: Pool size (defaults to the number of cores; 1 runs in-process)
+    seed: Seed for numpy.random.SeedSequence; each realization gets its own child
+          stream, so the result does not depend on processes or shards
+    shards: Number of tasks (defaults to 4 per process)
+    intensity: Return the mean |FFT|² instead of the psf()-style log scaling
+    '''
+    if pk is None:
+        pk = pupil.opts.get('pk', None)
+
+    if pk is None:
+        from .modelpf import ModelPupilFunction
+        pk = ModelPupilFunction.atm_Pk
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if shards is None:
+        shards = 4 * processes
+
+    shards = max(1, min(shards, realizations))
+
+    # Split the realizations as evenly as possible
+    seeds  = np.random.SeedSequence(seed).spawn(realizations)
+    bounds = np.linspace(0, realizations, shards + 1).astype(int)
+    tasks  = [seeds[bounds[i]:bounds[i + 1]] for i in range(shards)]
+
+    arrays = {
+        'aperture':  np.ascontiguousarray(pupil._mask(filtering), dtype=pupil.dtype),
+        'amplitude': np.ascontiguousarray(GaussianRandomField(pupil, dtype=np.float64).amplitude(pk)),
+    }
+
+    blocks = []
+    specs  = {}
+
+    try:
+        for name, arr in arrays.items():
+            shm = shared_memory.SharedMemory(create=True, size=arr.nbytes)
+            blocks.append(shm)
+
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            specs[name] = (shm.name, arr.shape, arr.dtype.str)
+
+        # Each process gets an equal share of the FFT threads
+        workers = max(1, multiprocessing.cpu_count() // processes)
+        initargs = (specs, pupil, k, filtering, noshift, workers)
+
+        total = np.zeros((pupil.samples, pupil.samples))
+        done  = 0
+
+        if processes == 1:
+            _attach(*initargs)
+
+            for task in tasks:
+                count, partial = _shard(task)
+                total += partial
+                done  += count
+
+            _detach()
+        else:
+            pool = multiprocessing.Pool(processes, initializer=_attach, initargs=initargs)
+
+            try:
+                for count, partial in pool.imap_unordered(_shard, tasks):
+                    total += partial
+                    done  += count
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    total /= done
+
+    if intensity:
+        return total
+
+    return (np.log10(1. + np.sqrt(total))**2.).astype(pupil.dtype)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+# Prefer the modern scipy.fft (multi-threaded pocketfft); fall back to numpy for old installs
+try:
+    import scipy.fft as _scipy_fft
+except ImportError: # Legacy scipy
+    _scipy_fft = None
+
+try:
+    import pyfftw.interfaces.scipy_fft as _pyfftw_fft
+    import pyfftw.interfaces.cache as _pyfftw_cache
+except ImportError: # Optional
+    _pyfftw_fft   = None
+    _pyfftw_cache = None
+
+class FFTBackend(object):
+    '''
+    Thin layer over the available FFT libraries
+
+    - name: 'scipy' (scipy.fft), 'pyfftw' or 'numpy'; defaults to the best one installed
+    - workers: Number of threads for each transform (-1 for all cores)
+
+    Plans are cached per shape by the library itself (pocketfft keeps an LRU of
+    plans; pyfftw's interface cache is switched on here).
+    '''
+
+    def __init__(self, name=None, workers=-1):
+        if name is None:
+            name = 'scipy' if _scipy_fft is not None else 'numpy'
+
+        if name == 'scipy' and _scipy_fft is None:
+            raise ValueError('scipy.fft is not available')
+        elif name == 'pyfftw' and _pyfftw_fft is None:
+            raise ValueError('pyfftw is not installed')
+        elif name not in ('scipy', 'pyfftw', 'numpy'):
+            raise ValueError('Unknown FFT backend \'%s\'' % (name))
+
+        if name == 'pyfftw':
+            _pyfftw_cache.enable()
+
+        self.name     = name
+        self.workers  = workers
+
+    def _lib(self):
+        if self.name == 'scipy':
+            return _scipy_fft
+        elif self.name == 'pyfftw':
+            return _pyfftw_fft
+
+        return np.fft
+
+    def _kwargs(self, workers, overwrite):
+        if self.name == 'numpy':
+            return {}
+
+        if workers is None:
+            workers = self.workers
+
+        return {'workers': workers, 'overwrite_x': overwrite}
+
+    def fft2(self, x, axes=(-2, -1), workers=None, overwrite=False):
+        return self._lib().fft2(x, axes=axes, **self._kwargs(workers, overwrite))
+
+    def ifft2(self, x, axes=(-2, -1), workers=None, overwrite=False):
+        return self._lib().ifft2(x, axes=axes, **self._kwargs(workers, overwrite))
+
+    def rfft2(self, x, axes=(-2, -1), workers=None):
+        return self._lib().rfft2(x, axes=axes, **self._kwargs(workers, False))
+
+    def irfft2(self, x, s=None, axes=(-2, -1), workers=None, overwrite=False):
+        return self._lib().irfft2(x, s=s, axes=axes, **self._kwargs(workers, overwrite))
+
+    def rfft2full(self, x, workers=None, out=None):
+        '''
+        Full 2-D spectrum of a real input, computed with a real-to-complex transform
+
+        The missing half follows from Hermitian symmetry: F[i, j] = conj(F[-i, -j])
+        out: Complex array to write the spectrum into. The half spectrum is still
+             allocated by the library: scipy.fft cannot transform into a given array,
+             and two passes into out run slower than the copy they save.
+        '''
+        x    = np.asarray(x)
+        n, m = x.shape[-2], x.shape[-1]
+        half = self.rfft2(x, workers=workers)
+
+        full = out if out is not None else np.empty(x.shape[:-2] + (n, m), dtype=half.dtype)
+        full[..., :m // 2 + 1] = half
+
+        if m // 2 + 1 < m:
+            # Columns m - j for j = m//2 + 1 ... m - 1, rows -i (mod n); slices avoid fancy indexing
+            mirror = half[..., (m - 1) // 2:0:-1]
+
+            np.conj(mirror[..., :1, :], out=full[..., :1, m // 2 + 1:])
+            np.conj(mirror[..., :0:-1, :], out=full[..., 1:, m // 2 + 1:])
+
+        return full
+
+    def fftshift(self, x, axes=(-2, -1)):
+        return np.fft.fftshift(x, axes=axes)
+
+    def absshift(self, x, out, shift=True):
+        '''
+        |x| written into out, fftshifted over the last two axes on the way when shift is True
+
+        Same result as abs(fftshift(x)) in a single pass, without the shifted copy
+        '''
+        if not shift:
+            return np.abs(x, out=out)
+
+        n, m = x.shape[-2], x.shape[-1]
+
+        # Source and destination blocks of fftshift: index i goes to (i + n//2) % n
+        rows = [(slice(0, n - n // 2), slice(n // 2, n)), (slice(n - n // 2, n), slice(0, n // 2))]
+        cols = [(slice(0, m - m // 2), slice(m // 2, m)), (slice(m - m // 2, m), slice(0, m // 2))]
+
+        for rsrc, rdst in rows:
+            for csrc, cdst in cols:
+                np.abs(x[..., rsrc, csrc], out=out[..., rdst, cdst])
+
+        return out
+
+    def fastlen(self, n):
+        '''
+        Smallest length >= n that the backend transforms efficiently
+        '''
+        if _scipy_fft is not None:
+            return int(_scipy_fft.next_fast_len(int(n)))
+
+        # 2^a 3^b 5^c fallback
+        n = int(n)
+
+        while True:
+            m = n
+
+            for p in (2, 3, 5):
+                while m % p == 0:
+                    m //= p
+
+            if m == 1:
+                return n
+
+            n += 1
+
+# Shared default backend
+backend = FFTBackend()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from .gaussianrndf import GaussianRandomField
+
+class FrozenFlowScreen(object):
+    '''
+    Phase screen drifting along +x, extended one column at a time
+
+    The screen starts as a single GaussianRandomField draw. New columns are
+    extruded from the last `depth` columns with the conditional Gaussian
+    (Assémat et al., Opt. Express 14, 988 (2006)): X = A Z + B b, where
+    A = C_xz C_zz⁻¹ and B Bᵀ = C_xx - A C_zz Aᵀ, with covariances taken from the
+    same amplitude spectrum that generated the screen. A, B are computed once;
+    each new column then costs two N×dN matrix-vector products.
+    '''
+
+    def __init__(self, pupil, pk, rng=None, depth=1):
+        self.samples = pupil.samples
+        self.depth   = depth
+
+        if rng is None or not isinstance(rng, np.random.Generator):
+            rng = np.random.default_rng(rng)
+
+        self.rng = rng
+
+        grf = GaussianRandomField(pupil, dtype=np.float64, rng=rng)
+
+        # Pixel-lag covariance of the screens: W = ifft2(n̂ a) ⇒ Cov[lag] = ifft2(a²)[lag]
+        amp      = grf.amplitude(pk)
+        self.cov = grf.fft.ifft2(np.abs(amp)**2.).real
+
+        self._operators()
+
+        # Ring buffer twice the screen width; the newest column is buffer[:, end - 1]
+        n = self.samples
+
+        self.buffer = np.empty((n, 2 * n))
+        self.buffer[:, :n] = grf.randomfield(pk).real
+        self.end    = n
+
+    def _covariance(self, ya, xa, yb, xb):
+        n = self.samples
+        return self.cov[(ya[:, None] - yb[None, :]) % n, (xa[:, None] - xb[None, :]) % n]
+
+    def _operators(self):
+        n    = self.samples
+        rows = np.arange(n)
+
+        # New column at x = 0, stencil columns at x = -depth ... -1
+        xz = np.repeat(np.arange(-self.depth, 0), n)
+        yz = np.tile(rows, self.depth)
+        xx = np.zeros(n, dtype=int)
+
+        Czz = self._covariance(yz, xz, yz, xz)
+        Cxz = self._covariance(rows, xx, yz, xz)
+        Cxx = self._covariance(rows, xx, rows, xx)
+
+        # Czz is close to singular (smooth screens, periodic modes); invert it on its numerical
+        # range only, the eigenvalues below the rank tolerance being noise that A would amplify
+        vals, vecs = np.linalg.eigh(Czz)
+        keep       = vals > vals[-1] * len(vals) * np.finfo(np.float64).eps
+        vals, vecs = vals[keep], vecs[:, keep]
+
+        self.A = (Cxz.dot(vecs) / vals[None, :]).dot(vecs.T)
+
+        # B Bᵀ = C_xx - A C_zx, the conditional covariance; rounding can leave it slightly
+        # indefinite, so it is symmetrized and its negative eigenvalues are dropped
+        cond       = Cxx - self.A.dot(Cxz.T)
+        vals, vecs = np.linalg.eigh(0.5 * (cond + cond.T))
+        self.B     = vecs * np.sqrt(np.clip(vals, 0., None))[None, :]
+
+    def extrude(self, columns=1):
+        '''
+        Appends new columns on the +x side of the screen
+        '''
+        n = self.samples
+
+        for i in range(columns):
+            if self.end == self.buffer.shape[1]:
+                # Move the live window back to the front of the buffer
+                self.buffer[:, :n] = self.buffer[:, self.end - n:self.end]
+                self.end = n
+
+            z = self.buffer[:, self.end - self.depth:self.end].T.ravel()
+            b = self.rng.standard_normal(n)
+
+            self.buffer[:, self.end] = self.A.dot(z) + self.B.dot(b)
+            self.end += 1
+
+    def window(self, offset=0):
+        '''
+        N×N view of the screen, `offset` columns behind the newest one
+        '''
+        end = self.end - offset
+        return self.buffer[:, end - self.samples:end]
+
+    def advance(self, shift):
+        '''
+        Scrolls the screen by an integer number of columns and returns the new window
+        '''
+        self.extrude(shift)
+        return self.window()
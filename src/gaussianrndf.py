@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import inspect
+import sys
 import numpy as np
-from scipy.fftpack import fft2
-from scipy.fftpack import ifft2
-from scipy.fftpack import fftshift
+
+from .diskcache import sourcedigest
+from .fftbackend import backend
+from .instrument import stage
 
 PI     = np.pi
 TWO_PI = 2. * PI
@@ -11,27 +14,141 @@ TWO_PI = 2. * PI
 class GaussianRandomField(object):
     '''
     Returns a gaussian random field given a function P(k)
+
+    rng: numpy.random.Generator or seed for reproducible fields; if None the
+         global np.random state is used
+
+    With an integer seed and a pupil that has a diskcache, the fields drawn
+    by randomfield are cached on disk, keyed on the mesh, pk, seed and draw number.
     '''
-    def __init__(self, pupil):
+    def __init__(self, pupil, dtype=None, rng=None):
 
         # Number of samples is consistent with pupil function
         self.samples = pupil.samples
 
-        self.KX, self.KY = pupil.fourierMesh()
+        # Share the pupil's FFT settings
+        self.fft     = getattr(pupil, 'fft', backend)
+        self.workers = getattr(pupil, 'workers', None)
+        self.budget  = getattr(pupil, 'budget', 2**30)
+        self.dtype   = dtype if dtype is not None else getattr(pupil, 'dtype', np.float64)
+
+        self.rng = None
 
-    def randomfield(self, pk):
-        noise = fft2(np.random.normal(size=(self.samples, self.samples)))
+        # Only integer seeds identify a reproducible sequence of draws
+        self.diskcache = getattr(pupil, 'diskcache', None)
+        self._seed     = int(rng) if isinstance(rng, (int, np.integer)) else None
+        self._draws    = 0
+        self._mesh     = {'samples': pupil.samples, 'diameter': pupil.diameter, 'padscale': pupil.padscale}
 
-        datapk  = None
+        if rng is not None:
+            self.rng = rng if isinstance(rng, np.random.Generator) else np.random.default_rng(rng)
 
+        # Open (1×N, N×1) axes; pk functions broadcast them to the full plane
+        self.KX, self.KY = pupil.fourierMesh(sparse=True)
+        self._pupil      = pupil
+
+        # Amplitude spectra of callable pk's, computed once per function
+        self._amplitudes = {}
+
+    def amplitude(self, pk):
+        '''
+        sqrt(conj(P) P) on the Fourier mesh; cached when pk is a function
+        '''
         if callable(pk):
-            # If the passed 'pk' is a function, use the builtin mesh to compute the power spectrum
-            datapk = pk(self.KX, self.KY)
-        else:
-            # Assuming the number crunching has already been done
-            datapk = pk
+            if pk not in self._amplitudes:
+                # If the passed 'pk' is a function, use the builtin mesh to compute the power spectrum
+                if 'k2' in self._parameters(pk):
+                    self._amplitudes[pk] = np.abs(pk(self.KX, self.KY, k2=self._pupil.fourierRadius2()))
+                else:
+                    self._amplitudes[pk] = np.abs(pk(self.KX, self.KY))
+
+            return self._amplitudes[pk]
+
+        # Assuming the number crunching has already been done
+        datapk = np.asarray(pk)
+
+        return np.sqrt(np.conj(datapk) * datapk)
+
+    @staticmethod
+    def _parameters(pk):
+        # Names of pk's arguments; pk's that take k2 get the pupil's cached kx² + ky² plane
+        try:
+            return inspect.signature(pk).parameters
+        except (TypeError, ValueError):
+            return {}
+
+    def _noise(self, shape, rng):
+        if rng is None:
+            rng = self.rng
+
+        if rng is None: # Legacy global state
+            return np.random.normal(size=shape).astype(self.dtype, copy=False)
+
+        if not isinstance(rng, np.random.Generator):
+            rng = np.random.default_rng(rng)
+
+        return rng.standard_normal(size=shape, dtype=self.dtype)
+
+    def randomfield(self, pk, rng=None):
+        # White noise is real, so a real-to-complex transform suffices
+        with stage('randomfield.noise'):
+            noise = self._noise((self.samples, self.samples), rng)
+
+        if rng is None and self._seed is not None and self.diskcache is not None and callable(pk):
+            # The noise is still drawn above so the generator state matches an uncached run
+            key = dict(self._mesh, kind='randomfield', dtype=np.dtype(self.dtype).str, pk=pk, seed=self._seed, draw=self._draws,
+                       code=sourcedigest([sys.modules[__name__], sys.modules[self.fft.__module__]]))
+            self._draws += 1
+
+            return self.diskcache.fetch(key, lambda: self._field(noise, pk))
+
+        return self._field(noise, pk)
+
+    def _field(self, noise, pk):
+        with stage('randomfield.fft'):
+            noise = self.fft.rfft2full(noise, workers=self.workers)
+
+        with stage('randomfield.spectrum'):
+            noise *= self.amplitude(pk)
+
+        with stage('randomfield.ifft'):
+            return self.fft.fftshift(self.fft.ifft2(noise, workers=self.workers, overwrite=True))
+
+    def randomfields(self, pk, count, rng=None):
+        '''
+        A (count, N, N) stack of independent fields from one batched transform
+        '''
+        with stage('randomfield.noise'):
+            noise = self._noise((count, self.samples, self.samples), rng)
+
+        if rng is None:
+            self._draws += count # Keep cached draw numbers in step with the generator
+
+        return self._field(noise, pk)
+
+    def stream(self, pk, count=None, batch=None, rng=None):
+        '''
+        Yields fields one at a time, generated in batches that fit within self.budget
+
+        count: Number of fields (None for an endless stream)
+        batch: Fields per batched transform (defaults to what the budget allows)
+        '''
+        if batch is None:
+            # Noise, its spectrum and the output are alive at once
+            batch = int(max(1, self.budget // (40 * self.samples**2)))
+
+        if rng is None:
+            rng = self.rng
+
+        if rng is not None and not isinstance(rng, np.random.Generator):
+            rng = np.random.default_rng(rng) # Keep one stream of numbers across batches
+
+        done = 0
+
+        while count is None or done < count:
+            m = batch if count is None else min(batch, count - done)
 
-        datapks   = np.conj(datapk)
-        amplitude = np.sqrt(datapks * datapk)
+            for field in self.randomfields(pk, m, rng=rng):
+                yield field
 
-        return fftshift(ifft2(noise * amplitude))
+            done += m
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from scipy.special import jn_zeros, j0, j1
+
+PI     = np.pi
+TWO_PI = 2. * PI
+
+class HankelTransform(object):
+    '''
+    Quasi-discrete Hankel transform of order 0
+    (Guizar-Sicairos & Gutiérrez-Vega, JOSA A 21, 53 (2004))
+
+    Computes F(ρ) = 2π ∫ f(r) J0(2πρr) r dr for a function vanishing beyond R,
+    sampled on the nodes r_k = j_k R / j_(n+1) and returning F on ρ_m = j_m / 2πR.
+    '''
+
+    def __init__(self, R, n):
+        self.R = float(R)
+        self.n = int(n)
+
+        zeros  = jn_zeros(0, self.n + 1)
+        self.j = zeros[:-1]
+        self.S = zeros[-1]                 # j_(n+1)
+        self.V = self.S / (TWO_PI * self.R) # Band limit in frequency
+
+        self.r   = self.j * self.R / self.S  # Sample radii
+        self.rho = self.j / (TWO_PI * self.R) # Output frequencies
+
+        self._J1 = np.abs(j1(self.j))
+
+    def transform(self, f, support=None):
+        '''
+        f: Values at self.r
+        support: Radius beyond which f is known to vanish; those columns of the
+                 transform matrix are never built
+        '''
+        f    = np.asarray(f, dtype=float)
+        cols = self.n
+
+        if support is not None:
+            cols = min(self.n, int(np.searchsorted(self.r, support, side='right')) + 1)
+
+        ft = f[:cols] * self.R / self._J1[:cols]
+
+        # T[m, k] = 2 J0(j_m j_k / S) / (|J1(j_m)| |J1(j_k)| S)
+        T  = j0(np.outer(self.j, self.j[:cols]) / self.S)
+        T *= 2. / (self._J1[:, None] * self._J1[None, :cols] * self.S)
+
+        return T.dot(ft) * self._J1 / self.V
+
+def nodes(R, rhomax, oversample=1.):
+    '''
+    Number of nodes needed to reach frequency rhomax over radius R
+    '''
+    # j_n ≈ π(n - 1/4), and ρ_n = j_n / 2πR
+    return int(np.ceil(oversample * 2. * R * rhomax + 1.))
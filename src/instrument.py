@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from time import perf_counter
+
+#### Stage timing hooks ####
+# Pupils and random fields wrap their stages (mask, phase, exp, FFT, ...) in
+#   with stage('psf.fft'):
+#       ...
+# The time spent is reported to the recorder installed for the current thread,
+# if any. Without a recorder a stage costs one attribute lookup.
+
+_local = threading.local()
+
+class _Stage(object):
+    '''
+    * Internal *
+
+    Times one stage and reports it to a recorder
+    '''
+    __slots__ = ('name', 'recorder', 'start')
+
+    def __init__(self, name, recorder):
+        self.name     = name
+        self.recorder = recorder
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder.record(self.name, perf_counter() - self.start)
+
+class _NoStage(object):
+    '''
+    * Internal *
+
+    Stand-in used while nothing is recording
+    '''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_nostage = _NoStage()
+
+def stage(name):
+    recorder = getattr(_local, 'recorder', None)
+
+    if recorder is None:
+        return _nostage
+
+    return _Stage(name, recorder)
+
+def instrument(recorder):
+    '''
+    Installs recorder (anything with a record(stage, seconds) method, or None)
+    for the calling thread and returns the previous one
+    '''
+    previous = getattr(_local, 'recorder', None)
+    _local.recorder = recorder
+
+    return previous
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from .cubestore import PSFCube
+
+#### PSF quality metrics ####
+# Every metric takes a single PSF (N×N) or a stack of them (..., N, N), such as a
+# psf_cube or a PSFCube, and reduces all slices together: the radial binning is
+# one np.bincount per batch of slices, batches being sized to fit budget bytes.
+#
+# Inputs are psf() output, log10(1 + |F|)², unless log=False, in which case they
+# are taken to be intensities |F|² already. Normalized PSFs (normalize=True) have
+# lost their scale and cannot be converted back to intensities.
+#
+# Lengths are in pixels of the PSF grid; multiply by pixel(pupil) for k-space units.
+
+_indices = {} # (shape, center, square) -> (index, counts, radii)
+
+def intensity(psf):
+    '''
+    |F|² from psf() output, log10(1 + |F|)²
+    '''
+    return np.square(10.**np.sqrt(np.asarray(psf, dtype=np.float64)) - 1.)
+
+def pixel(pupil, window=None, npix=None):
+    '''
+    Size of one PSF pixel in k-space units, for psf(..., window=window, npix=npix)
+    '''
+    if window is not None:
+        axis = pupil.windowAxis(window, npix)
+        return axis[1] - axis[0]
+
+    return 2. * pupil.nyqfreq() / pupil.samples
+
+def radiusindex(shape, center=None, square=False):
+    '''
+    Cached radial bin of every pixel of a shape (ny, nx) image, flattened
+
+    Bin j holds the pixels whose distance from center (defaults to the middle pixel,
+    where psf() puts k = 0) rounds to j. With square, the distance is max(|dx|, |dy|)
+    so bin j is the border of the square of half-width j.
+
+    Returns (index, counts, radii): counts and mean radius of each bin
+    '''
+    shape = tuple(shape)
+
+    if center is None:
+        center = (shape[0] // 2, shape[1] // 2)
+
+    key = (shape, tuple(center), square)
+
+    if key not in _indices:
+        dy = np.abs(np.arange(shape[0]) - center[0])[:, None]
+        dx = np.abs(np.arange(shape[1]) - center[1])[None, :]
+
+        if square:
+            r = np.maximum(dx, dy).astype(np.float64)
+        else:
+            r = np.hypot(dx, dy)
+
+        index  = np.rint(r).astype(np.intp).ravel()
+        counts = np.bincount(index)
+        radii  = np.bincount(index, weights=r.ravel()) / np.maximum(counts, 1)
+
+        _indices[key] = (index, counts, radii)
+
+    return _indices[key]
+
+def _array(psf):
+    # Stacks may be given as a PSFCube; its memmap is read batch by batch
+    return psf.data if isinstance(psf, PSFCube) else np.asarray(psf)
+
+def _batches(psf, log, budget):
+    '''
+    * Internal *
+
+    Yields (start, block) with block a (slices, ny·nx) float64 array of intensities
+    '''
+    lead  = psf.shape[:-2]
+    npix  = psf.shape[-2] * psf.shape[-1]
+    flat  = psf.reshape((-1, npix))
+    chunk = int(max(1, budget // (24 * npix))) # Intensities plus bin numbers
+
+    for start in range(0, flat.shape[0], chunk):
+        block = flat[start:start + chunk]
+        block = intensity(block) if log else np.asarray(block, dtype=np.float64)
+
+        yield start, block
+
+def _binsums(psf, center, square, log, budget):
+    '''
+    * Internal *
+
+    Sums of the intensity in each radial bin, shape (..., bins), plus the bin index
+    '''
+    psf = _array(psf)
+
+    index, counts, radii = radiusindex(psf.shape[-2:], center, square)
+
+    nbins  = len(counts)
+    slices = int(np.prod(psf.shape[:-2], dtype=np.intp))
+    sums   = np.empty((slices, nbins))
+    bins   = None
+
+    for start, block in _batches(psf, log, budget):
+        n = len(block)
+
+        if bins is None or len(bins) < n:
+            # Bin numbers of slice i are offset by i·nbins, so one bincount covers the batch
+            bins = index[None, :] + nbins * np.arange(n)[:, None]
+
+        sums[start:start + n] = np.bincount(bins[:n].ravel(), weights=block.ravel(), minlength=n * nbins).reshape((n, nbins))
+
+    return sums.reshape(psf.shape[:-2] + (nbins,)), counts, radii
+
+def radialprofile(psf, center=None, log=True, budget=2**28):
+    '''
+    Azimuthally averaged intensity
+
+    Returns (r, profile): mean radius of each bin and the mean intensity in it, with
+    profile of shape (..., bins)
+    '''
+    sums, counts, radii = _binsums(psf, center, False, log, budget)
+
+    return radii, sums / counts
+
+def _cumulative(psf, center, square, log, budget):
+    sums, counts, radii = _binsums(psf, center, square, log, budget)
+
+    energy  = np.cumsum(sums, axis=-1)
+    energy /= energy[..., -1:]
+
+    # Bin j reaches out to j + ½ (the centre pixel alone for j = 0)
+    return np.arange(len(counts)) + .5, energy
+
+def encircled(psf, center=None, log=True, budget=2**28):
+    '''
+    Encircled energy: fraction of the total intensity within radius r
+
+    Returns (r, fraction) with fraction of shape (..., bins)
+    '''
+    return _cumulative(psf, center, False, log, budget)
+
+def ensquared(psf, center=None, log=True, budget=2**28):
+    '''
+    Ensquared energy: fraction of the total intensity within the square of half-width h
+
+    Returns (h, fraction) with fraction of shape (..., bins)
+    '''
+    return _cumulative(psf, center, True, log, budget)
+
+def radiusof(r, fraction, level):
+    '''
+    Radius at which encircled (or ensquared) energy first reaches level, interpolated
+    '''
+    j  = np.argmax(fraction >= level, axis=-1)
+    j0 = np.maximum(j - 1, 0)
+
+    lo = np.take_along_axis(fraction, j0[..., None], axis=-1)[..., 0]
+    hi = np.take_along_axis(fraction, j[..., None], axis=-1)[..., 0]
+    t  = np.where(hi > lo, (level - lo) / np.where(hi > lo, hi - lo, 1.), 0.)
+
+    return np.where(j == 0, r[0], r[j0] + t * (r[j] - r[j0]))
+
+def fwhm(psf, center=None, log=True, budget=2**28):
+    '''
+    Full width at half maximum of the azimuthally averaged profile, shape (...)
+
+    Found where the profile first drops below half its peak (beyond the peak itself),
+    interpolated linearly between bins; cores only a few pixels wide are better measured on a window.
+    '''
+    r, profile = radialprofile(psf, center, log, budget)
+
+    peak  = np.argmax(profile, axis=-1)
+    half  = np.take_along_axis(profile, peak[..., None], axis=-1) / 2.
+    below = (profile < half) & (np.arange(len(r)) > peak[..., None])
+    j     = np.maximum(np.argmax(below, axis=-1), 1)
+
+    p0 = np.take_along_axis(profile, (j - 1)[..., None], axis=-1)[..., 0]
+    p1 = np.take_along_axis(profile, j[..., None], axis=-1)[..., 0]
+    t  = (p0 - half[..., 0]) / np.where(p0 > p1, p0 - p1, 1.) # p0 ≥ half > p1 where found
+
+    # NaN where the profile never falls to half its peak
+    return np.where(np.any(below, axis=-1), 2. * (r[j - 1] + t * (r[j] - r[j - 1])), np.nan)
+
+def strehl(psf, reference, log=True, budget=2**28):
+    '''
+    Strehl ratio, shape (...): peak of the energy-normalized PSF over the peak of the
+    energy-normalized reference (the aberration-free PSF, see referencepsf)
+    '''
+    psf  = _array(psf)
+    ref  = intensity(reference) if log else np.asarray(reference, dtype=np.float64)
+    lead = psf.shape[:-2]
+    out  = np.empty(int(np.prod(lead, dtype=np.intp)))
+
+    if ref.ndim > 2:
+        # One reference per slice
+        ref = ref.reshape((-1,) + ref.shape[-2:])
+
+    peak = np.amax(ref, axis=(-2, -1)) / np.sum(ref, axis=(-2, -1))
+
+    for start, block in _batches(psf, log, budget):
+        n = len(block)
+        p = peak if np.ndim(peak) == 0 else peak[start:start + n]
+
+        out[start:start + n] = np.amax(block, axis=1) / np.sum(block, axis=1) / p
+
+    return out.reshape(lead)
+
+def referencepsf(pupil, k=20., filtering=False, window=None, npix=None):
+    '''
+    psf() of the pupil with its phase screen removed: same aperture and grid, no aberrations
+
+    The PSF grid does not depend on k, so one reference serves a whole psf_cube.
+    '''
+    if pupil.isReal():
+        return pupil.psf(k=k, filtering=filtering, window=window, npix=npix)
+
+    flat = np.broadcast_to(0., (pupil.samples, pupil.samples))
+
+    return pupil.psf(k=k, filtering=filtering, window=window, npix=npix, screen=flat)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+PI     = np.pi
+TWO_PI = 2. * PI
+
+def dftmatrix(f, x):
+    '''
+    Rows of exp(-2πi f x) for output frequencies f and input sample positions x
+    '''
+    return np.exp(-TWO_PI * 1j * np.outer(f, x))
+
+def mft2(img, x, fx, fy=None, ctype=np.complex128, y=None):
+    '''
+    Matrix Fourier transform of img (indexed img[y, x]) onto arbitrary frequencies
+
+    Computes F[j, i] = Σ img[n, m] exp(-2πi (fx[i] x[m] + fy[j] y[n])) as two matrix
+    products, so the cost is O(N²M + NM²) rather than an N² log N FFT whose
+    output is mostly discarded.
+
+    img: Ny×Nx image sampled at positions x along its columns and y along its rows
+    fx, fy: Output frequencies (fy defaults to fx)
+    ctype: Complex dtype of the transform matrices (phases are always computed in double)
+    y: Row positions (default to x, for a square image)
+    '''
+    if fy is None:
+        fy = fx
+
+    if y is None:
+        y = x
+
+    Ex = dftmatrix(fx, x).astype(ctype, copy=False) # (Mx, Nx)
+    Ey = dftmatrix(fy, y).astype(ctype, copy=False) # (My, Ny)
+
+    return Ey.dot(img.dot(Ex.T))                    # (My, Mx)
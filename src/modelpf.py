@@ -2,6 +2,7 @@ import numpy as np
 
 from .abstractpf import AbstractPupilFunction
 from .gaussianrndf import GaussianRandomField
+from .frozenflow import FrozenFlowScreen
 
 #### Globals ####
 PI     = np.pi
@@ -18,36 +19,84 @@ class ModelPupilFunction(AbstractPupilFunction):
     '''
 
     strut_width = 0.04
+    maskopts    = ('b',)
+
+    # The mask also depends on the strut width
+    _depends = dict(AbstractPupilFunction._depends)
+    _depends['aperture'] = _depends['aperture'] + ('strut_width',)
+    _depends['coverage'] = _depends['coverage'] + ('strut_width',)
+    _depends['support']  = _depends['support'] + ('strut_width',)
+    _depends['hankel']   = _depends['hankel'] + ('strut_width',)
+
+    def applySetting(self, k, v):
+        if k == 'strut_width':
+            self.strut_width = v
+            self._invalidate(k)
+        else:
+            super(ModelPupilFunction, self).applySetting(k, v)
 
     def pFunc(self, x, y):
-        pass1 = np.where((x)**2 + (y)**2 <= (self.radius())**2, 1., 0.)
-        pass2 = np.where((x)**2 + (y)**2 > ((self.opts['b'] / 2.)**2), pass1, 0.)
-        pass3 = np.where(np.abs(x) < ModelPupilFunction.strut_width*self.radius(), 0., pass2)
-        pass4 = np.where(np.abs(y) < ModelPupilFunction.strut_width*self.radius(), 0., pass3)
+        r2    = self.radius2(x, y)
+        pass1 = np.where(r2 <= (self.radius())**2, 1., 0.)
+        pass2 = np.where(r2 > ((self.opts['b'] / 2.)**2), pass1, 0.)
+        pass3 = np.where(np.abs(x) < self.strut_width*self.radius(), 0., pass2)
+        pass4 = np.where(np.abs(y) < self.strut_width*self.radius(), 0., pass3)
         return pass4
 
+    def isSymmetric(self):
+        # Only without struts; turbulence is ruled out separately by isReal()
+        return self.strut_width == 0
+
     def wFunc(self, x, y):
         if self.hasOption('turbulence') and self.opts['turbulence'] is False:
-            return np.zeros((self.samples, self.samples))
+            return 0.
         else:
-            # Init the field
-            if not hasattr(self, 'gaussfield'):
-                self.gaussfield = GaussianRandomField(self)
+            # A fresh field on every call; phase() keeps one per instance to simulate a particular mirror
+            gaussfield = GaussianRandomField(self, dtype=np.float64, rng=self.opts.get('seed'))
+            return gaussfield.randomfield(ModelPupilFunction.atm_Pk)
+ 
+    def timeseries(self, k, frames, velocity=1., filtering=False, noshift=False, rng=None, depth=1):
+        '''
+        Generator of short-exposure PSFs under frozen-flow turbulence
 
-            # In case the generated field is not rendered
-            # We want to preserve the same field for a single instance to simulate
-            # a particular mirror. Also good for consistent and comparable images
-            if not hasattr(self, 'renderedField'):
-                self.renderedField = self.gaussfield.randomfield(ModelPupilFunction.atm_Pk(self.gaussfield.KX, self.gaussfield.KY))
+        One screen is synthesized up front and then drifts along +x, extended
+        column by column (see FrozenFlowScreen); each frame cuts the pupil-sized
+        window out of it, so no frame pays for a new random field.
+
+        k: Wavenumber of light (2π / λ)
+        frames: Number of frames (None for an endless stream)
+        velocity: Wind speed in pixels per frame; fractional speeds accumulate
+        rng: numpy.random.Generator or seed (defaults to opts['seed'])
+        depth: Number of trailing columns conditioning each new column
+        '''
+        if rng is None:
+            rng = self.opts.get('seed')
+
+        flow   = FrozenFlowScreen(self, ModelPupilFunction.atm_Pk, rng=rng, depth=depth)
+        moved  = 0.
+        shift  = 0
+        frame  = 0
+
+        while frames is None or frame < frames:
+            yield self.psf(k=k, filtering=filtering, noshift=noshift, screen=flow.window())
+
+            # Only whole columns are extruded; the remainder carries over to the next frame
+            moved += velocity
+            step   = int(np.floor(moved)) - shift
+            shift += step
+            frame += 1
+
+            if step > 0:
+                flow.extrude(step)
 
-            return self.renderedField
- 
     @staticmethod
-    def atm_Pk(kx, ky):
+    def atm_Pk(kx, ky, k2=None):
         '''
         Models atmospheric turbulence according to Von Karman spectrum
 
         http://community.dur.ac.uk/james.osborn/thesis/thesisse3.html
+
+        k2: kx² + ky² if already at hand (GaussianRandomField passes the pupil's cached plane)
         '''
         l_min = 10e-3  # meters
         l_max = 20.   # meters
@@ -56,7 +105,8 @@ class ModelPupilFunction(AbstractPupilFunction):
         k_M = 5.92 / l_min
         k_0 = TWO_PI / l_max
 
-        k2 = kx**2. + ky**2.
+        if k2 is None:
+            k2 = kx**2. + ky**2.
 
         # k2 = np.where(k2 < k_0**2, 0., k2)
         # k2 = np.where(k2 > k_M**2, 0., k2)
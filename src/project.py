@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 # Main document
+import os
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -13,6 +14,10 @@ from .cassegausspf import DirtyCassegrainPupilFunction
 from .squarepf import SquarePupilFunction
 from .gaussianrndf import GaussianRandomField
 from .modelpf import ModelPupilFunction
+from .registry import PupilRegistry
+from .fftbackend import backend
+from . import metrics
+from .instrument import instrument # Stage timing hook used by datamaster --profile
 
 #### Globals ####
 PI     = np.pi
@@ -26,33 +31,40 @@ k_green = TWO_PI / (550e-9)
 
 diameter = 6.5
 
+# Results of seeded/phase-free pupils are kept on disk between sessions
+cachedir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.psfcache')
+seed     = 1 # Seed for every phase screen, so they can be cached
+
 # DIAMETERS ARE IN METERS
-pupil  = SimplePupilFunction(diameter=diameter, samples=N_samples, padscale=ps)
-dirty  = DirtySimplePupilFunction(diameter=diameter, samples=N_samples, padscale=ps, pk=ModelPupilFunction.atm_Pk)
-caspup = CassegrainPupilFunction(diameter=diameter, b=1.5, samples=N_samples, padscale=ps)
-dcaspf = DirtyCassegrainPupilFunction(diameter=diameter, b=1.5, samples=N_samples, padscale=ps)
-square = SquarePupilFunction(diameter=diameter, samples=N_samples, padscale=ps)
-model  = ModelPupilFunction(diameter=.250, b=.110, samples=N_samples, padscale=ps)
+# Pupils are only built the first time a plot uses them
+pupils = PupilRegistry()
 
-model_turb  = ModelPupilFunction(diameter=.250, b=.110, samples=N_samples, padscale=ps, turbulence=False)
-gauss       = GaussianRandomField(pupil)
+pupils.declare('pupil',  SimplePupilFunction, diameter=diameter, samples=N_samples, padscale=ps, diskcache=cachedir)
+pupils.declare('dirty',  DirtySimplePupilFunction, diameter=diameter, samples=N_samples, padscale=ps, pk=ModelPupilFunction.atm_Pk, seed=seed, diskcache=cachedir)
+pupils.declare('caspup', CassegrainPupilFunction, diameter=diameter, b=1.5, samples=N_samples, padscale=ps, diskcache=cachedir)
+pupils.declare('dcaspf', DirtyCassegrainPupilFunction, diameter=diameter, b=1.5, samples=N_samples, padscale=ps, pk=ModelPupilFunction.atm_Pk, seed=seed, diskcache=cachedir)
+pupils.declare('square', SquarePupilFunction, diameter=diameter, samples=N_samples, padscale=ps, diskcache=cachedir)
+pupils.declare('model',  ModelPupilFunction, diameter=.250, b=.110, samples=N_samples, padscale=ps, seed=seed, diskcache=cachedir)
 
-#### Memory management ####
-def terminate():
-    global pupil
-    pupil = None
+pupils.declare('model_turb', ModelPupilFunction, diameter=.250, b=.110, samples=N_samples, padscale=ps, turbulence=False, diskcache=cachedir)
+pupils.declare('gauss',      lambda: GaussianRandomField(pupils.pupil))
 
-    global caspup
-    caspup = None
+#### Memory management ####
+def release():
+    # Drops every built pupil; they are rebuilt on demand
+    pupils.release()
 
-    global square
-    square = None
+def restore(old):
+    # Called by datamaster after a hot reload; keeps the pupils whose declaration did not change
+    if isinstance(old.get('pupils'), PupilRegistry):
+        kept = pupils.adopt(old['pupils'])
 
-    global dirty
-    dirty = None
+        if len(kept) != 0:
+            print('Kept pupils: %s' % (', '.join(kept)))
 
-    global dcaspf
-    dcaspf = None
+def threads(n):
+    # Called by datamaster in each batch process; FFT threads of every pupil using the shared backend
+    backend.workers = n
 
 #### Drawing logic ####
 def render_pupil(pupilFunc, k=TWO_PI, color=None, filtering=True):
@@ -81,15 +93,34 @@ def render_psf(pupilFunc, k=TWO_PI, color=None, noshift=False, filtering=True, l
     '''
     pupilFunc: The complex Pupil Function to analyze
     k: Wavenumber of light (2π / λ)
+    limited: Only compute the central region; windowed PSFs are always centered, so
+             noshift draws the full grid instead
     '''
     # PSF
-    psf = pupilFunc.psf(k=k, filtering=filtering, noshift=noshift)  # Generate PSF
-    psf = psf / np.amax(psf)                                   # Rescale output so max value is 1. (luminance)
-    psf = np.where(psf > 1e-15, psf, 0.)                       # Filter very low values
+    window = None
+    npix   = None
+
+    limited = limited and not noshift
+
+    if limited:
+        # Only compute the region shown, for comparison purposes
+        window = (-10., 10.)
+        npix   = 512
+
+    n   = npix if limited else pupilFunc.samples
+    psf = np.empty((n, n), dtype=pupilFunc.dtype)              # Owned by the figure, so filled in place below
+
+    pupilFunc.psf(k=k, filtering=filtering, noshift=noshift, window=window, npix=npix, out=psf) # Generate PSF
+    psf /= np.amax(psf)                                        # Rescale output so max value is 1. (luminance)
+    psf[psf <= 1e-15] = 0.                                     # Filter very low values
 
     # Relevant k's
-    spacing = 1. / (2. * pupilFunc.nyqfreq())                  # Spacing from Nyquist frequency
-    k       = fftshift(fftfreq(pupilFunc.samples, d=spacing))  # The actual k's
+    if limited:
+        k = pupilFunc.windowAxis(window, npix)                 # The sampled window
+    else:
+        spacing = 1. / (2. * pupilFunc.nyqfreq())              # Spacing from Nyquist frequency
+        k       = fftshift(fftfreq(pupilFunc.samples, d=spacing))  # The actual k's
+
     k_map   = [k[0], k[-1], k[-1], k[0]]                       # Because imshow is oriented top-left, remap k extrema
 
     # Draw
@@ -104,32 +135,34 @@ def render_psf(pupilFunc, k=TWO_PI, color=None, noshift=False, filtering=True, l
     ax.set_xlabel('$k_x$ ($m^{-1}$)')
     ax.set_ylabel('$k_y$ ($m^{-1}$)')
 
-    if limited:
-        # adding limits for comparison purposes
-        ax.set_xlim([-10, 10])
-        ax.set_ylim([-10, 10])
+def psf_range(pupilFunc, k, noshift=False, filtering=True, chromatic=False):
+    '''
+    Broadband PSF drawn by render_psf_range, scaled so its max value is 1.
+
+    k: Wavenumbers of light (2π / λ)
+    chromatic: Draw psf_broadband instead of the psf_cube sum: each wavelength's pattern
+               scaled by k / max(k), for phase-free pupils only (a different product,
+               not a faster way to the same one)
+    '''
+    if chromatic:
+        if noshift:
+            raise ValueError('Chromatic PSFs are always centered')
 
-def render_psf_range(pupilFunc, k, color=None, noshift=False, filtering=True):
+        psf = pupilFunc.psf_broadband(k, filtering=filtering, normalize=True)                      # Rescaled reference PSF
+    else:
+        psf = pupilFunc.psf_cube(k, filtering=filtering, noshift=noshift, normalize=True, summed=True) # Batched broadband PSF
+
+    return psf / np.amax(psf)
+
+def render_psf_range(pupilFunc, k, color=None, noshift=False, filtering=True, chromatic=False):
     '''
     pupilFunc: The complex Pupil Function to analyze
     k: Wavenumber of light (2π / λ)
+    chromatic: Draw the chromatically rescaled PSF (see psf_range)
     '''
 
     # PSF
-    psf = None
-
-    for kval in k:
-        if psf is None:
-            psf = pupilFunc.psf(k=kval, filtering=filtering, noshift=noshift) # Generate PSF
-            psf = psf / np.amax(psf)                                          # Rescale output so max value is 1. (luminance)
-            psf = np.where(psf > 1e-15, psf, 0.)                              # Filter very low values
-        else:
-            s   = pupilFunc.psf(k=kval, filtering=filtering, noshift=noshift) # Generate PSF
-            s   = s / np.amax(s)
-            s   = np.where(s > 1e-15, s, 0.)
-            psf += s
-
-    psf = psf / np.amax(psf)
+    psf = psf_range(pupilFunc, k, noshift=noshift, filtering=filtering, chromatic=chromatic)
 
     # Relevant k's
     spacing = 1. / (2. * pupilFunc.nyqfreq())                  # Spacing from Nyquist frequency
@@ -148,62 +181,92 @@ def render_psf_range(pupilFunc, k, color=None, noshift=False, filtering=True):
     ax.set_xlabel('$k_x$ ($m^{-1}$)')
     ax.set_ylabel('$k_y$ ($m^{-1}$)')
 
+def psf_metrics(pupilFunc, k, filtering=True):
+    '''
+    Strehl ratio, FWHM and 50% encircled-energy radius (both in m^-1) for each k
+
+    Slices are computed a batch at a time, as many as the pupil's memory budget
+    allows, and each batch is measured in one vectorized pass.
+    k: Wavenumbers of light (2π / λ)
+    '''
+    k = np.atleast_1d(np.asarray(k, dtype=float))
+
+    reference = metrics.intensity(metrics.referencepsf(pupilFunc, filtering=filtering)) # One for all k's
+    scale     = metrics.pixel(pupilFunc)                                               # m^-1 per PSF pixel
+    chunk     = int(max(1, pupilFunc.budget // (32 * pupilFunc.samples**2)))            # Same batches as psf_cube
+
+    strehl = np.empty(len(k))
+    fwhm   = np.empty(len(k))
+    ee50   = np.empty(len(k))
+
+    for start in range(0, len(k), chunk):
+        batch = slice(start, start + chunk)
+        cube  = metrics.intensity(pupilFunc.psf_cube(k[batch], filtering=filtering))
+
+        r, ee = metrics.encircled(cube, log=False)
+
+        strehl[batch] = metrics.strehl(cube, reference, log=False)
+        fwhm[batch]   = metrics.fwhm(cube, log=False) * scale
+        ee50[batch]   = metrics.radiusof(r, ee, .5) * scale
+
+    return strehl, fwhm, ee50
+
 #### Interactivity ####
 # Pupils
 def plot_simplepupil():
-    render_pupil(pupil, color='gray')
+    render_pupil(pupils.pupil, color='gray')
 
 def plot_cassepupil():
-    render_pupil(caspup, color='gray')
+    render_pupil(pupils.caspup, color='gray')
 
 def plot_squarepupil():
-    render_pupil(square, color='gray')
+    render_pupil(pupils.square, color='gray')
 
 def plot_gsimplepupil():
-    render_pupil(dirty, k=k_green, color='gray')
+    render_pupil(pupils.dirty, k=k_green, color='gray')
 
 def plot_modelpupil():
-    render_pupil(model, k=k_green, color='gray')
+    render_pupil(pupils.model, k=k_green, color='gray')
 
 def plot_modeltpupil():
-    render_pupil(model_turb, k=k_green, color='gray')
+    render_pupil(pupils.model_turb, k=k_green, color='gray')
 
 # PSFs
 def plot_simplepsf():
-    render_psf(pupil, color='magma')
+    render_psf(pupils.pupil, color='magma')
 
 def plot_simplepsfg():
-    render_psf(pupil, k=k_green, color='magma', limited=False)
+    render_psf(pupils.pupil, k=k_green, color='magma', limited=False)
 
 def plot_gsimplepsf():
-    render_psf(dirty, color='magma')
+    render_psf(pupils.dirty, color='magma')
 
 def plot_cassepsf():
-    render_psf(caspup, color='magma', limited=False)
+    render_psf(pupils.caspup, color='magma', limited=False)
 
 def plot_gcassepsf():
-    render_psf(dcaspf)
+    render_psf(pupils.dcaspf)
 
 def plot_squarepsf():
-    render_psf(square)
+    render_psf(pupils.square)
 
 def plot_modeltpsf():
-    render_psf(model_turb, k=k_green, color='magma', limited=False)
+    render_psf(pupils.model_turb, k=k_green, color='magma', limited=False)
 
 def plot_modelpsfr():
-    render_psf(model, color='magma', k=k_red, limited=False)
+    render_psf(pupils.model, color='magma', k=k_red, limited=False)
 
 def plot_modelpsfg():
-    render_psf(model, color='magma', k=k_green, limited=False)
+    render_psf(pupils.model, color='magma', k=k_green, limited=False)
 
 def plot_modelpsfb():
-    render_psf(model, color='magma', k=k_blue, limited=False)
+    render_psf(pupils.model, color='magma', k=k_blue, limited=False)
 
 def plot_modelpsfcomp():
-    render_psf_range(model, [k_red, k_green, k_blue], color='magma')
+    render_psf_range(pupils.model, [k_red, k_green, k_blue], color='magma')
 
 def plot_modeltpsfcomp():
-    render_psf_range(model_turb, TWO_PI / np.linspace(400e-9, 700e-9, 50), color='magma')
+    render_psf_range(pupils.model_turb, TWO_PI / np.linspace(400e-9, 700e-9, 50), color='magma')
 
 # Misc
 def plot_gauss():
@@ -220,14 +283,14 @@ def plot_gauss():
 
         return ret
 
-    field = gauss.randomfield(test_power_spec)
+    field = pupils.gauss.randomfield(test_power_spec)
     field = np.sqrt(field.real**2. + field.imag**2.)
     field = field / np.amax(field)
 
     # Relevant k's
-    spacing = 1. / (2. * pupil.nyqfreq())                  # Spacing from Nyquist frequency
-    k       = fftshift(fftfreq(pupil.samples, d=spacing))  # The actual k's
-    k_map   = [k[0], k[-1], k[-1], k[0]]                   # Because imshow is oriented top-left, remap k extrema
+    spacing = 1. / (2. * pupils.pupil.nyqfreq())                  # Spacing from Nyquist frequency
+    k       = fftshift(fftfreq(pupils.pupil.samples, d=spacing))  # The actual k's
+    k_map   = [k[0], k[-1], k[-1], k[0]]                          # Because imshow is oriented top-left, remap k extrema
 
     plt.figure()
     plt.imshow(field, interpolation='none', cmap=plt.get_cmap('bone'), extent=k_map, vmin=np.amin(field), vmax=np.amax(field))
@@ -239,14 +302,14 @@ def plot_gauss():
 
 def plot_gaussatm():
     # check the random field is working
-    field = gauss.randomfield(ModelPupilFunction.atm_Pk)
+    field = pupils.gauss.randomfield(ModelPupilFunction.atm_Pk)
     field = np.sqrt(field.real**2. + field.imag**2.)
     field = field / np.amax(field)
 
     # Relevant k's
-    spacing = 1. / (2. * pupil.nyqfreq())                  # Spacing from Nyquist frequency
-    k       = fftshift(fftfreq(pupil.samples, d=spacing))  # The actual k's
-    k_map   = [k[0], k[-1], k[-1], k[0]]                   # Because imshow is oriented top-left, remap k extrema
+    spacing = 1. / (2. * pupils.pupil.nyqfreq())                  # Spacing from Nyquist frequency
+    k       = fftshift(fftfreq(pupils.pupil.samples, d=spacing))  # The actual k's
+    k_map   = [k[0], k[-1], k[-1], k[0]]                          # Because imshow is oriented top-left, remap k extrema
 
     plt.figure()
     plt.imshow(field, interpolation='none', cmap=plt.get_cmap('bone'), extent=k_map, vmin=np.amin(field), vmax=np.amax(field))
@@ -265,3 +328,119 @@ def test_power_spec(kx, ky, power=-2.):
     ret = TWO_PI*(ret / np.amax(ret))
 
     return ret
+
+# Metrics
+metric_pupils = ['pupil', 'dirty', 'caspup', 'dcaspf', 'square', 'model', 'model_turb']
+
+def get_strehl():
+    # Strehl ratio of the model pupil across the visible band
+    wavelengths = np.linspace(400e-9, 700e-9, 100)
+
+    strehl, fwhm, ee50 = psf_metrics(pupils.model, TWO_PI / wavelengths)
+
+    lines = ['%-12s %10s %14s %14s' % ('λ (nm)', 'Strehl', 'FWHM (m^-1)', 'EE50 (m^-1)')]
+
+    for i in range(0, len(wavelengths), 11):
+        lines.append('%-12.1f %10.4f %14.4f %14.4f' % (1e9 * wavelengths[i], strehl[i], fwhm[i], ee50[i]))
+
+    lines.append('%-12s %10.4f %14.4f %14.4f' % ('mean', np.mean(strehl), np.nanmean(fwhm), np.mean(ee50)))
+
+    return '\n'.join(lines)
+
+def get_fwhm():
+    # FWHM (m^-1) of each pupil's PSF in green light
+    lines = []
+
+    for name in metric_pupils:
+        try:
+            pupilFunc = pupils.get(name)
+            psf       = pupilFunc.psf(k=k_green, filtering=True)
+        except Exception as err:
+            lines.append('%-12s failed: %s' % (name, err))
+            continue
+
+        lines.append('%-12s %10.4f' % (name, metrics.fwhm(psf) * metrics.pixel(pupilFunc)))
+
+    return '\n'.join(lines)
+
+def get_encircled():
+    # Radii (m^-1) holding 50% and 80% of each pupil's PSF energy in green light
+    lines = ['%-12s %10s %10s %10s' % ('pupil', 'EE50', 'EE80', 'ES80')]
+
+    for name in metric_pupils:
+        try:
+            pupilFunc = pupils.get(name)
+            psf       = metrics.intensity(pupilFunc.psf(k=k_green, filtering=True))
+        except Exception as err:
+            lines.append('%-12s failed: %s' % (name, err))
+            continue
+
+        scale = metrics.pixel(pupilFunc)
+
+        r, ee = metrics.encircled(psf, log=False)
+        h, es = metrics.ensquared(psf, log=False)
+
+        lines.append('%-12s %10.4f %10.4f %10.4f' % (name, metrics.radiusof(r, ee, .5) * scale, metrics.radiusof(r, ee, .8) * scale, metrics.radiusof(h, es, .8) * scale))
+
+    return '\n'.join(lines)
+
+#### Runnables ####
+def run_precision(samples=512):
+    '''
+    Compares single- against double-precision PSFs for each pupil class
+    Errors are relative to the PSF peak (after the usual normalization)
+    '''
+    specs = [
+        ('Simple',         SimplePupilFunction,      dict(diameter=diameter)),
+        ('DirtySimple',    DirtySimplePupilFunction, dict(diameter=diameter, pk=ModelPupilFunction.atm_Pk)),
+        ('Cassegrain',     CassegrainPupilFunction,  dict(diameter=diameter, b=1.5)),
+        ('Square',         SquarePupilFunction,      dict(diameter=diameter)),
+        ('Model',          ModelPupilFunction,       dict(diameter=.250, b=.110)),
+        ('Model (no turb)', ModelPupilFunction,      dict(diameter=.250, b=.110, turbulence=False)),
+    ]
+
+    print('%-16s %12s %12s' % ('pupil', 'max err', 'mean err'))
+
+    for name, cls, opts in specs:
+        psfs = []
+
+        for precision in ('double', 'single'):
+            np.random.seed(0) # Same screen in both precisions
+
+            pf  = cls(samples=samples, padscale=ps, precision=precision, **opts)
+            psf = pf.psf(k=k_green, filtering=True).astype(np.float64)
+            psfs.append(psf / np.amax(psf))
+
+        err = np.abs(psfs[1] - psfs[0])
+
+        print('%-16s %12.3e %12.3e' % (name, np.amax(err), np.mean(err)))
+
+def run_broadband(samples=512, scales=(1., .9, .75, .57)):
+    '''
+    Compares psf_broadband against psf() on the scaled window, for each phase-free pupil class
+    Errors are relative to the PSF peak
+    '''
+    specs = [
+        ('Simple',          SimplePupilFunction,     dict(diameter=diameter)),
+        ('Cassegrain',      CassegrainPupilFunction, dict(diameter=diameter, b=1.5)),
+        ('Square',          SquarePupilFunction,     dict(diameter=diameter)),
+        ('Model (no turb)', ModelPupilFunction,      dict(diameter=.250, b=.110, turbulence=False)),
+    ]
+
+    print('%-16s %8s %12s' % ('pupil', 'k / k0', 'max err'))
+
+    for name, cls, opts in specs:
+        pf = cls(samples=samples, padscale=ps, precision='double', **opts)
+        f  = fftshift(fftfreq(samples, d=1. / (2. * pf.nyqfreq())))
+
+        for s in scales:
+            exact = pf.psf(window=(f[0] * s, f[-1] * s), npix=samples)
+            bb    = pf.psf_broadband([s], k0=1.)
+
+            print('%-16s %8.2f %12.3e' % (name, s, np.amax(np.abs(bb - exact)) / np.amax(exact)))
+
+def run_benchmark():
+    # Quick pass over every pupil class; python -m src.benchmark runs the full grid and compares runs
+    from . import benchmark
+
+    benchmark.run(samples=[256, 512], padscale=[ps], repeat=3)
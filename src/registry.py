@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+class PupilRegistry(object):
+    '''
+    Lazily built, named objects (pupils, random fields, ...)
+
+    Objects are declared as specs and only constructed the first time they are
+    looked up, either as registry.get('name') or registry.name. Lookups are
+    thread-safe, so concurrent callers never build the same object twice.
+    '''
+
+    def __init__(self):
+        self._specs = {} # name -> (factory, opts)
+        self._built = {} # name -> object
+        self._lock  = threading.RLock() # Reentrant: factories may look up other entries
+
+    def declare(self, name, factory, **opts):
+        '''
+        Declares name as factory(**opts); replaces any earlier spec and instance
+        '''
+        self._specs[name] = (factory, opts)
+        self.release(name)
+
+    def get(self, name):
+        built = self._built.get(name)
+
+        if built is not None:
+            return built
+
+        with self._lock:
+            if name not in self._built:
+                if name not in self._specs:
+                    raise KeyError('No pupil declared as \'%s\'' % (name))
+
+                factory, opts = self._specs[name]
+                self._built[name] = factory(**opts)
+
+            return self._built[name]
+
+    def __getattr__(self, name):
+        # Only called when normal lookup fails; never treat private names as specs
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        try:
+            return self.get(name)
+        except KeyError as err:
+            raise AttributeError(str(err))
+
+    def adopt(self, other):
+        '''
+        Takes over the instances built by another registry whose spec is unchanged
+        (same factory object and equal options); used to keep pupils across a hot reload
+        Returns the names that were kept
+        '''
+        kept = []
+
+        with self._lock:
+            for name, spec in self._specs.items():
+                if name in self._built or name not in other._built:
+                    continue
+
+                try:
+                    same = other._specs.get(name) == spec
+                except ValueError: # Array-valued options; treat as changed
+                    same = False
+
+                if same:
+                    self._built[name] = other._built[name]
+                    kept.append(name)
+
+        return sorted(kept)
+
+    def __contains__(self, name):
+        return name in self._specs
+
+    def declared(self):
+        return sorted(self._specs.keys())
+
+    def built(self):
+        return sorted(self._built.keys())
+
+    def release(self, name=None):
+        '''
+        Drops built instances (all of them if name is None); specs are kept
+        '''
+        if name is None:
+            self._built = {}
+        elif name in self._built:
+            del self._built[name]
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import threading
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+from .cubestore import PSFCube
+from .fftbackend import backend
+from .metrics import ensquared, intensity
+
+TILE_BYTES     = 32 # Per FFT pixel of a tile in flight: scene block, its transform, the sum, the image
+SPECTRUM_BYTES = 8  # Per FFT pixel of each cached kernel transform (n × (n/2 + 1) complex)
+
+class SceneConvolver(object):
+    '''
+    Images of extended scenes seen through a PSF, by tiled FFT convolution
+
+    The output is cut into tiles that are convolved independently (overlap-save:
+    each tile reads its halo of the scene, only the part of the circular convolution
+    free of wrap-around is kept), so neither the scene nor the output has to fit in
+    memory. The PSF transform is computed once per tile size and reused by every tile.
+
+    psf: (n, n) PSF, or an (L, n, n) stack (ndarray or PSFCube) of per-wavelength PSFs
+    weights: Spectral weights of the L PSFs (defaults to 1 for each)
+    log: psf is psf() output, log10(1 + |F|)², rather than an intensity
+    normalize: Scale every PSF to unit sum so the flux of the scene is conserved
+    tail: Fraction of the PSF energy that may be cut from its wings; the kernel is cropped
+          to the smallest centered square holding the rest, which bounds the halo of the tiles
+
+    With L PSFs and a single-plane scene, the weighted PSFs are summed first (the
+    convolution is linear); with an (L, H, W) scene, plane l is convolved with PSF l
+    and the products are summed in Fourier space, so each tile has one inverse FFT.
+    '''
+
+    def __init__(self, psf, weights=None, log=True, normalize=True, tail=1e-6, fft=backend):
+        psf = psf.data if isinstance(psf, PSFCube) else np.asarray(psf)
+
+        kernel = intensity(psf) if log else np.array(psf, dtype=np.float64)
+        kernel = self._crop(kernel.reshape((-1,) + kernel.shape[-2:]), tail)
+
+        if weights is None:
+            weights = np.ones(len(kernel))
+        else:
+            weights = np.asarray(weights, dtype=float)
+
+            if weights.shape != (len(kernel),):
+                raise ValueError('weights must have one entry per PSF')
+
+        if normalize:
+            kernel /= np.sum(kernel, axis=(1, 2), keepdims=True)
+
+        kernel *= weights[:, None, None]
+
+        self.kernel = kernel
+        self.fft    = fft
+
+        self._spectra = {} # (FFT size, summed) -> kernel transforms, for the last size only
+        self._lock    = threading.Lock()
+
+    @staticmethod
+    def _crop(kernel, tail):
+        '''
+        * Internal *
+
+        kernel cut to the smallest square around its middle pixel (where psf() puts k = 0)
+        holding all but tail of the energy of its planes
+        '''
+        kh, kw = kernel.shape[-2:]
+        cy, cx = kh // 2, kw // 2
+
+        h, fraction = ensquared(np.sum(np.abs(kernel), axis=0), center=(cy, cx), log=False)
+        j           = int(np.argmax(fraction >= 1. - tail))
+
+        # Only crop an axis that keeps the middle pixel in the middle
+        if j < min(cy, kh - 1 - cy):
+            kernel = kernel[:, cy - j:cy + j + 1]
+
+        if j < min(cx, kw - 1 - cx):
+            kernel = kernel[:, :, cx - j:cx + j + 1]
+
+        return np.ascontiguousarray(kernel)
+
+    @property
+    def size(self):
+        return self.kernel.shape[-2:]
+
+    def spectrum(self, n, planes):
+        '''
+        Cached real-to-complex transforms of the kernel zero-padded to n×n
+
+        planes: Number of scene planes; a single plane gets the summed kernel
+        '''
+        key = (n, planes == 1)
+
+        with self._lock:
+            if key not in self._spectra:
+                kernel = self.kernel
+
+                if planes == 1:
+                    kernel = np.sum(kernel, axis=0, keepdims=True)
+                elif planes != len(kernel):
+                    raise ValueError('The scene needs one plane per PSF (or a single plane)')
+
+                padded = np.zeros((len(kernel), n, n))
+                padded[:, :kernel.shape[1], :kernel.shape[2]] = kernel
+
+                # Transforms of other sizes are dropped; they count against the budget
+                self._spectra = {key: self.fft.rfft2(padded)}
+
+        return self._spectra[key]
+
+    def fftsize(self, shape, tile=None, processes=1, budget=2**30, planes=1):
+        '''
+        FFT size of one tile; tile (output pixels per side) defaults to between 2 and 4
+        times the kernel size, as large as budget allows for the kernel transforms plus
+        processes tiles in flight
+
+        Raises MemoryError if not even the smallest tile fits in budget
+        '''
+        kh, kw = self.size
+        halo   = max(kh, kw) - 1
+
+        if tile is not None:
+            return self.fft.fastlen(tile + halo)
+
+        spectra = 1 if planes == 1 else len(self.kernel)
+        fit     = int(np.sqrt(budget / float(SPECTRUM_BYTES * spectra + TILE_BYTES * processes)))
+        whole   = max(shape) + halo # One tile covering the scene
+        least   = min(2 * (halo + 1), whole)
+
+        n = min(fit, 4 * (halo + 1), whole)
+
+        if n < least:
+            raise MemoryError('A budget of %d bytes does not fit %d tile(s) of %d×%d for a %d×%d kernel' % (budget, processes, least, least, kh, kw))
+
+        if self.fft.fastlen(n) <= fit:
+            return self.fft.fastlen(n)
+
+        # Rounding up would break the budget: largest fast length below n, else n itself
+        m = n
+
+        while m > least and self.fft.fastlen(m) != m:
+            m -= 1
+
+        return m if self.fft.fastlen(m) == m else n
+
+    def threads(self, shape, processes, budget=2**30, planes=1):
+        '''
+        Number of tiles convolved at once: processes, or fewer if the budget cannot hold
+        that many of the smallest tiles
+        '''
+        kh, kw = self.size
+        halo   = max(kh, kw) - 1
+        least  = min(2 * (halo + 1), max(shape) + halo)**2
+        free   = budget - SPECTRUM_BYTES * (1 if planes == 1 else len(self.kernel)) * least
+
+        return int(max(1, min(processes, free // (TILE_BYTES * least))))
+
+    def _tile(self, scene, out, rows, cols, n, spectra, workers):
+        '''
+        * Internal *
+
+        Convolves the part of scene under out[rows, cols] and writes it there
+        '''
+        kh, kw = self.size
+        cy, cx = kh // 2, kw // 2 # psf() puts k = 0 on the middle pixel
+
+        # Scene rows r0 - (kh - 1 - cy) ... r1 + cy - 1 feed output rows r0 ... r1 - 1
+        top, left = rows.start - (kh - 1 - cy), cols.start - (kw - 1 - cx)
+        bottom    = rows.stop + cy
+        right     = cols.stop + cx
+
+        H, W   = scene.shape[-2:]
+        block  = np.empty((n, n))
+        sr, sc = slice(max(top, 0), min(bottom, H)), slice(max(left, 0), min(right, W))
+        total  = None
+
+        # Plane by plane, so a tile holds one block and one transform whatever the number of planes
+        for l in range(scene.shape[0]):
+            block[...] = 0. # Zero outside the scene
+            block[sr.start - top:sr.stop - top, sc.start - left:sc.stop - left] = scene[l, sr, sc]
+
+            transform  = self.fft.rfft2(block, workers=workers)
+            transform *= spectra[l]
+
+            if total is None:
+                total = transform
+            else:
+                total += transform
+
+        image = self.fft.irfft2(total, s=(n, n), workers=workers, overwrite=True)
+
+        out[rows, cols] = image[kh - 1:kh - 1 + rows.stop - rows.start, kw - 1:kw - 1 + cols.stop - cols.start]
+
+    def convolve(self, scene, path=None, tile=None, processes=None, budget=2**30, dtype=np.float64):
+        '''
+        scene ⊛ psf, the same size as the scene (which is taken to be zero outside)
+
+        scene: (H, W) or (L, H, W) array; a path to a .npy file is memory-mapped
+        path: Stream the image into a .npy file there (memory-mapped, returned open)
+        tile: Output pixels per tile side (see fftsize)
+        processes: Threads convolving tiles (defaults to the number of cores, fewer if
+                   budget is short); the FFT threads are divided among them
+        budget: Bytes for the kernel transforms and the tiles in flight
+        '''
+        if isinstance(scene, str):
+            scene = np.load(scene, mmap_mode='r')
+
+        if scene.ndim == 2:
+            scene = scene[None]
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        H, W      = scene.shape[-2:]
+        kh, kw    = self.size
+        processes = self.threads((H, W), processes, budget, len(scene))
+        n         = self.fftsize((H, W), tile, processes, budget, len(scene))
+        spectra   = self.spectrum(n, len(scene))
+        step      = n - max(kh, kw) + 1 # Output pixels per tile side
+        workers   = max(1, multiprocessing.cpu_count() // processes)
+
+        if path is not None:
+            out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(H, W))
+        else:
+            out = np.empty((H, W), dtype=dtype)
+
+        tiles = [(slice(r, min(r + step, H)), slice(c, min(c + step, W))) for r in range(0, H, step) for c in range(0, W, step)]
+        task  = lambda rc: self._tile(scene, out, rc[0], rc[1], n, spectra, workers)
+
+        if processes > 1 and len(tiles) > 1:
+            pool = ThreadPool(min(processes, len(tiles)))
+
+            try:
+                pool.map(task, tiles)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for rc in tiles:
+                task(rc)
+
+        if path is not None:
+            out.flush()
+
+        return out
+
+def simulate(scene, psf, weights=None, path=None, log=True, normalize=True, **opts):
+    '''
+    Image of scene through psf (or a weighted PSF cube); see SceneConvolver
+    '''
+    tail = opts.pop('tail', 1e-6)
+
+    return SceneConvolver(psf, weights, log=log, normalize=normalize, tail=tail).convolve(scene, path=path, **opts)
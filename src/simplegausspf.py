@@ -1,3 +1,5 @@
+import numpy as np
+
 from .simplepf import SimplePupilFunction
 from .gaussianrndf import GaussianRandomField
 
@@ -11,15 +13,5 @@ class DirtySimplePupilFunction(SimplePupilFunction):
         super(DirtySimplePupilFunction, self).__init__(**opts)
 
     def wFunc(self, x, y):
-
-        # Init the field
-        if not hasattr(self, 'gaussfield'):
-            self.gaussfield = GaussianRandomField(self)
-
-        # In case the generated field is not rendered
-        # We want to preserve the same field for a single instance to simulate
-        # a particular mirror. Also good for consistent and comparable images
-        if not hasattr(self, 'renderedField'):
-            self.renderedField = self.gaussfield.randomfield(self.opts['pk'])
-
-        return self.renderedField
+        # A fresh field on every call; phase() keeps one per instance to simulate a particular mirror
+        return GaussianRandomField(self, dtype=np.float64, rng=self.opts.get('seed')).randomfield(self.opts['pk'])
@@ -12,7 +12,10 @@ class SimplePupilFunction(AbstractPupilFunction):
     '''
 
     def pFunc(self, x, y):
-        return 1.*np.where((x)**2. + (y)**2. > (self.radius())**2, 0., 1.)
+        return 1.*np.where(self.radius2(x, y) > (self.radius())**2, 0., 1.)
+
+    def isSymmetric(self):
+        return True
 
     def wFunc(self, x, y):
-        return np.zeros((self.samples, self.samples))
+        return 0.
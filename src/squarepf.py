@@ -1,8 +1,5 @@
 import numpy as np
 
-from scipy.fftpack import fft2
-from scipy.fftpack import fftshift
-
 from .abstractpf import AbstractPupilFunction
 
 class SquarePupilFunction(AbstractPupilFunction):
@@ -12,4 +9,4 @@ class SquarePupilFunction(AbstractPupilFunction):
         return np.where(np.abs(y) <= self.radius(), step1, 0.)
 
     def wFunc(self, x, y):
-        return np.zeros((self.samples, self.samples))
+        return 0.
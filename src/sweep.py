@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+from .cubestore import CubeWriter, PSFCube, jsonable, pupilmeta
+
+#### Parameter sweeps ####
+# A sweep evaluates psf() over the cartesian product of a grid of settings, e.g.
+#
+#   sweep(ModelPupilFunction, {'b': [.05, .1, .15], 'strut_width': [0., .02, .04]}, k=k_green,
+#         settings=dict(diameter=.25, samples=1024, padscale=2., seed=1))
+#
+# Points are grouped by the settings that are not mask parameters (samples, padscale,
+# diameter, seed, ...): each group builds one pupil, so meshes and the phase screen are
+# made once and shared. Within a group the masks for all values of the mask parameters
+# come from one call of pupil.apertures, and the PSFs are spread over a thread pool
+# (FFTs release the GIL; each thread has its own workspace buffers in the pupil).
+#
+# 'k' may be swept as well; it then takes the place of the k argument.
+
+def maskparameters(cls, names):
+    '''
+    Those of names that only change the aperture of cls, not its meshes or phase screen
+    '''
+    deps = cls._depends
+
+    return [n for n in names if n in cls.maskopts or (n in deps['aperture'] and n not in deps['phase'])]
+
+class Sweep(object):
+    '''
+    PSFs of a parameter sweep, labeled by the swept values
+
+    axes: [(name, values), ...] in grid order
+    data: Array of shape (len(values_0), len(values_1), ..., ny, nx); data[i, j, ...]
+          is the PSF at the i-th value of the first axis, j-th of the second, ...
+    meta: Pupil class, fixed settings and psf arguments of the sweep
+    '''
+
+    def __init__(self, axes, data, meta=None):
+        self.axes = [(name, list(values)) for name, values in axes]
+        self.data = data
+        self.meta = meta or {}
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Sweep written with sweep(..., path=path), memory-mapped
+        '''
+        cube = PSFCube(path)
+        axes = cube.meta['axes']
+
+        shape = tuple(len(values) for name, values in axes) + cube.shape[1:]
+
+        return cls(axes, cube.data.reshape(shape), cube.meta)
+
+    @property
+    def names(self):
+        return [name for name, values in self.axes]
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def index(self, **point):
+        '''
+        Index into data of the given values; axes left out are taken whole
+        '''
+        index = []
+
+        for name, values in self.axes:
+            if name in point:
+                index.append(values.index(point[name]))
+            else:
+                index.append(slice(None))
+
+        unknown = set(point) - set(self.names)
+
+        if len(unknown) != 0:
+            raise KeyError('Not swept: %s' % (', '.join(sorted(unknown))))
+
+        return tuple(index)
+
+    def sel(self, **point):
+        return self.data[self.index(**point)]
+
+    def points(self):
+        '''
+        Yields (point, psf) for every point of the sweep, point being a dict of settings
+        '''
+        names = self.names
+
+        for index in np.ndindex(*self.data.shape[:len(names)]):
+            yield dict((name, self.axes[i][1][j]) for i, (name, j) in enumerate(zip(names, index))), self.data[index]
+
+def _evaluate(task):
+    '''
+    * Internal *
+
+    Computes one PSF of the sweep straight into its slot of the output
+    '''
+    pupil, aperture, k, args, out = task
+
+    pupil.psf(k=k, aperture=aperture, out=out, **args)
+
+def sweep(cls, grid, k=None, settings=None, filtering=False, noshift=False, window=None, npix=None, processes=None, path=None):
+    '''
+    psf() of cls over every combination of the values in grid; returns a Sweep
+
+    grid: Ordered {setting: [values]}; settings are those accepted by cls (diameter,
+          padscale, b, ...), attributes such as strut_width, or 'k'
+    k: Wavenumber of light (2π / λ), unless swept
+    settings: Fixed settings of every point
+    processes: Threads computing PSFs (defaults to the number of cores); the FFT
+               threads of each pupil are divided among them
+    path: Also write the PSFs to a cube store at path (see cubestore.py); the returned
+          Sweep is then memory-mapped from it and can be reopened with Sweep.load
+    '''
+    settings = dict(settings or {})
+    names    = list(grid.keys())
+    axes     = [(name, list(grid[name])) for name in names]
+
+    if k is None and 'k' not in grid:
+        raise ValueError('k must be given or swept')
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    masks = []
+
+    if not settings.get('hankel') and 'hankel' not in grid:
+        # The Hankel path needs the pupil's own aperture, so with it every point gets its own pupil
+        masks = maskparameters(cls, [n for n in names if n != 'k'])
+
+    others = [n for n in names if n != 'k' and n not in masks]
+
+    # Points of each group share one pupil; their masks differ, their k's may too
+    shape  = tuple(len(values) for name, values in axes)
+    groups = {}
+
+    for index in np.ndindex(*shape):
+        point = dict((name, axes[i][1][j]) for i, (name, j) in enumerate(zip(names, index)))
+        key   = tuple(point[n] for n in others)
+
+        groups.setdefault(key, []).append((index, point))
+
+    args  = dict(filtering=filtering, noshift=noshift, window=window, npix=npix)
+    meta  = {'kind': 'sweep', 'axes': axes, 'k': k, 'settings': settings, 'psf': args}
+    data  = None
+    write = None
+
+    pool = ThreadPool(processes) if processes > 1 else None
+
+    try:
+        for key, members in groups.items():
+            opts = dict(settings, workers=max(1, multiprocessing.cpu_count() // processes))
+            opts.update(zip(others, key))
+
+            pupil = cls(**opts)
+            pupil.phase() # Build the shared screen before the threads need it
+
+            n = pupil.samples if window is None else (npix or pupil.samples)
+
+            if data is not None and data.shape[-1] != n:
+                raise ValueError('Swept points must share the PSF shape; give a window and npix to sweep samples')
+
+            if data is None:
+                meta['pupil'] = pupilmeta(pupil)
+
+                if path is not None:
+                    write = CubeWriter(path, (int(np.prod(shape)), n, n), dtype=pupil.dtype, meta=meta)
+                    data  = write.data.reshape(shape + (n, n))
+                else:
+                    data = np.empty(shape + (n, n), dtype=pupil.dtype)
+
+            apertures = {None: None}
+
+            if len(masks) != 0:
+                # One mask per distinct combination of mask parameters, all from one pFunc call
+                combos    = sorted(set(tuple(point[m] for m in masks) for index, point in members))
+                stack     = pupil.apertures(**dict((m, [c[i] for c in combos]) for i, m in enumerate(masks)))
+                apertures = dict(zip(combos, stack))
+
+            tasks = []
+
+            for index, point in members:
+                aperture = apertures[tuple(point[m] for m in masks) if len(masks) != 0 else None]
+                tasks.append((pupil, aperture, point.get('k', k), args, data[index]))
+
+            if pool is not None:
+                pool.map(_evaluate, tasks)
+            else:
+                for task in tasks:
+                    _evaluate(task)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if write is not None:
+            write.close()
+
+    if path is not None:
+        return Sweep.load(path)
+
+    return Sweep(axes, data, jsonable(meta))
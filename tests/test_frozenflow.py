@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from src.frozenflow import FrozenFlowScreen
+from src.modelpf import ModelPupilFunction
+from src.simplepf import SimplePupilFunction
+
+N     = 32
+SEEDS = 60
+LAGS  = (1, 2, 4, 8)
+
+def vonkarman(n):
+    # Amplitude spectrum in FFT order, outer scale of one screen width
+    f  = np.fft.fftfreq(n)
+    k2 = f[None, :]**2. + f[:, None]**2.
+
+    return (k2 + 1. / n**2.)**(-11. / 12.)
+
+def theory(amp):
+    # Variance and structure function along x of screens drawn from amp
+    cov = np.fft.ifft2(amp**2.).real
+
+    return cov[0, 0], np.array([2. * (cov[0, 0] - cov[0, l]) for l in LAGS])
+
+def statistics(pk, depth, columns, pupil=None):
+    '''
+    Ensemble mean of the window variance and of the structure function along x
+    after extruding columns columns, one screen per seed
+    '''
+    if pupil is None:
+        pupil = SimplePupilFunction(samples=N)
+
+    var = 0.
+    D   = np.zeros(len(LAGS))
+
+    for seed in range(SEEDS):
+        window = FrozenFlowScreen(pupil, pk, rng=seed, depth=depth).advance(columns)
+
+        var += np.mean(window**2.)
+        D   += [np.mean((window[:, l:] - window[:, :-l])**2.) for l in LAGS]
+
+    return var / SEEDS, D / SEEDS
+
+@pytest.mark.parametrize('depth', [1, 2, 3, 4])
+def test_extrusion_keeps_statistics(depth):
+    amp = vonkarman(N)
+
+    var, D         = statistics(amp, depth, 8 * N)
+    var0, expected = theory(amp)
+
+    # The stencil reproduces the covariance exactly across its own width
+    near = [i for i, l in enumerate(LAGS) if l <= depth]
+
+    assert var == pytest.approx(var0, rel=.15)
+    assert D[near] == pytest.approx(expected[near], rel=.1)
+
+def test_deep_stencil_structure_function():
+    amp = vonkarman(N)
+
+    var, D         = statistics(amp, 4, 8 * N)
+    var0, expected = theory(amp)
+
+    assert D == pytest.approx(expected, rel=.1)
+
+@pytest.mark.parametrize('depth', [1, 2, 3, 4])
+def test_extrusion_stays_bounded(depth):
+    # The stencil covariance of von Karman screens on the pupil mesh is nearly singular
+    pupil = ModelPupilFunction(samples=2 * N, padscale=2., diameter=.25, b=.11)
+    var0  = FrozenFlowScreen(pupil, ModelPupilFunction.atm_Pk, rng=0, depth=depth).cov[0, 0]
+
+    var, D = statistics(ModelPupilFunction.atm_Pk, depth, 16 * N, pupil)
+
+    assert np.isfinite(var) and var < 2. * var0